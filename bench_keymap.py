@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Benchmark the keymap generator on the real layers and synthetic stress cases.
+
+Reports the median time of each stage (column widths, row formatting,
+header assembly, the streamed render plus atomic file write, and the same
+render with the JSON and SVG exports fed from the same pass) and the peak
+traced memory of a full render.
+Results can be saved with --json and compared against an earlier run with
+--baseline, failing when any stage got slower than the allowed ratio.
+"""
+
+import argparse
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from format_keymap import (KeymapEmitter, Layer, column_widths, emit_keymap, format_macros,
+                           format_row, header, inline_macros, layers, macros, shield_geometry,
+                           start_profiling, write_outputs)
+
+STAGES = ("widths", "rows", "header", "write", "exports")
+
+
+def long_bindings(grid):
+    """Return grid with every binding stretched to a long modifier chain."""
+    return [[f"&kp LC(LS(LA(LG({key.split()[-1]}))))" if key else "" for key in row]
+            for row in grid]
+
+
+def full_grid(grid):
+    """Return grid with every cell filled, including the ones the TOTEM lacks."""
+    return [[key or "&trans" for key in row] for row in grid]
+
+
+def cases():
+    """Return {case name: (layers, macros)} for the benchmark."""
+    real_layers, real_macros, _, _ = inline_macros(layers, macros)
+    many = [Layer(f"{name}_{i}", label, grid) for i in range(40) for name, label, grid in real_layers]
+    return {
+        "real": (real_layers, real_macros),
+        "many_layers": (many, real_macros * 5),
+        "long_bindings": ([Layer(n, l, long_bindings(g)) for n, l, g in many], real_macros),
+        "full_grids": ([Layer(n, l, full_grid(long_bindings(g))) for n, l, g in many], real_macros),
+    }
+
+
+def time_stages(case_layers, case_macros, tmp):
+    """Return {stage: seconds} for one pass over a case."""
+    times = {}
+    geometry = shield_geometry()
+    start = time.perf_counter()
+    widths = [column_widths(grid) for _, _, grid in case_layers]
+    times["widths"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for (_, _, grid), col_widths in zip(case_layers, widths):
+        for row in grid:
+            format_row(row, col_widths, geometry.split)
+    times["rows"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    head = header + format_macros(case_macros)
+    times["header"] = time.perf_counter() - start
+
+    out_path = os.path.join(tmp, "bench.keymap")
+    start = time.perf_counter()
+    write_outputs({"keymap": out_path}, head, case_layers, case_macros, geometry)
+    times["write"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    write_outputs({"keymap": out_path, "json": os.path.join(tmp, "bench.json"),
+                   "svg": os.path.join(tmp, "bench.svg")}, head, case_layers, case_macros, geometry)
+    times["exports"] = time.perf_counter() - start
+    return times
+
+
+def peak_memory(case_layers, case_macros):
+    """Return peak traced bytes while rendering a case into memory."""
+    tracemalloc.start()
+    try:
+        geometry = shield_geometry()
+        emit_keymap([KeymapEmitter(io.BytesIO(), geometry)], header + format_macros(case_macros),
+                    case_layers, geometry)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run(repeat):
+    """Benchmark every case; returns {case: {stage: median ms, "peak_kib": KiB}}."""
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, (case_layers, case_macros) in cases().items():
+            runs = [time_stages(case_layers, case_macros, tmp) for _ in range(repeat)]
+            result = {stage: statistics.median(r[stage] for r in runs) * 1000 for stage in STAGES}
+            result["peak_kib"] = peak_memory(case_layers, case_macros) / 1024
+            results[name] = result
+    return results
+
+
+def regressions(results, baseline, ratio):
+    """Return messages for stages slower than ratio times the baseline."""
+    found = []
+    for case, stages in results.items():
+        for stage in STAGES:
+            old = baseline.get(case, {}).get(stage)
+            if old and stages[stage] > old * ratio:
+                found.append(f"{case}/{stage}: {old:.2f} ms -> {stages[stage]:.2f} ms")
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=20, help="passes per case (median is reported)")
+    parser.add_argument("--json", metavar="PATH", help="save results as JSON")
+    parser.add_argument("--baseline", metavar="PATH", help="JSON results to compare against")
+    parser.add_argument("--max-ratio", type=float, default=1.25,
+                        help="fail when a stage is slower than this ratio of the baseline")
+    parser.add_argument("--profile", nargs="?", const="bench_keymap", metavar="PREFIX",
+                        help="dump cProfile stats to PREFIX.prof and a tracemalloc snapshot to PREFIX.mem")
+    args = parser.parse_args()
+    if args.profile:
+        start_profiling(args.profile)
+
+    results = run(args.repeat)
+    print(f"{'case':<14}" + "".join(f"{stage + ' ms':>11}" for stage in STAGES) + f"{'peak KiB':>11}")
+    for case, stages in results.items():
+        print(f"{case:<14}" + "".join(f"{stages[stage]:>11.3f}" for stage in STAGES)
+              + f"{stages['peak_kib']:>11.0f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(results, json.load(f), args.max_ratio)
+        for message in found:
+            print(f"Regression: {message}")
+        if found:
+            sys.exit(1)
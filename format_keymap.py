@@ -1,110 +1,1166 @@
 #!/usr/bin/env python3
-"""Format ZMK keymap layers as 14x4 grids."""
-
-def format_layer(name, label, grid):
-    """Format layer from 14x4 grid. Col 6 gets +6 padding, others +2."""
-    col_widths = [max(len(grid[r][c]) for r in range(4)) for c in range(14)]
-
-    def fmt_row(row_idx):
-        parts = []
-        for col in range(14):
-            key = grid[row_idx][col]
-            w = col_widths[col]
-            pad = 6 if col == 6 else 2
-            if col == 13:
-                parts.append(key)
-            else:
-                parts.append(f"{key:<{w + pad}}")
-        return "".join(parts).rstrip()
+"""Format ZMK keymap layers as grids laid out like the shield's matrix transform."""
+
+import argparse
+from array import array
+import atexit
+import contextlib
+import cProfile
+import filecmp
+import itertools
+import hashlib
+import json
+import os
+import re
+import runpy
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+
+from keymap_emitters import JsonEmitter, SvgEmitter
+from keymap_geometry import layout_path, load_geometry
+from keymap_watch import watch_changes
+
+# Interned bindings: every distinct binding string is stored once and grids
+# hold its index. ID 0 is the empty cell of positions the board lacks.
+binding_strings = [""]
+binding_ids = {"": 0}
+
+def intern_binding(binding):
+    """Return the ID of binding, adding it to the table if new."""
+    binding_id = binding_ids.get(binding)
+    if binding_id is None:
+        binding_id = binding_ids[binding] = len(binding_strings)
+        binding_strings.append(binding)
+    return binding_id
+
+def substitute(binding, substitutions):
+    """Return binding with the first matching prefix in substitutions replaced."""
+    for old, new in substitutions.items():
+        if binding.startswith(old):
+            return new + binding[len(old):]
+    return binding
+
+class Layer:
+    """A layer whose grid is stored as interned binding IDs.
+
+    Unpacks and indexes like the (name, label, grid) tuples the rest of the
+    generator passes around; grid is built from the IDs the first time it is
+    needed and shared after that, as rows of tuples.
+    """
+
+    __slots__ = ("name", "label", "width", "_cells", "_grid")
+
+    def __init__(self, name, label, grid):
+        self.name = name
+        self.label = label
+        self.width = len(grid[0])
+        self._cells = array("H", [intern_binding(key) for row in grid for key in row])
+        self._grid = None
+
+    @classmethod
+    def from_cells(cls, name, label, width, cells):
+        """Return a layer over binding IDs that are already interned."""
+        layer = cls.__new__(cls)
+        layer.name = name
+        layer.label = label
+        layer.width = width
+        layer._cells = cells
+        layer._grid = None
+        return layer
+
+    @property
+    def cells(self):
+        """Binding IDs in row-major order."""
+        return self._cells
+
+    @property
+    def grid(self):
+        if self._grid is None:
+            strings = binding_strings
+            cells = self.cells
+            width = self.width
+            self._grid = [tuple([strings[i] for i in cells[start:start + width]])
+                          for start in range(0, len(cells), width)]
+        return self._grid
+
+    def derive(self, name, label, substitutions):
+        """Return a layer with this layer's bindings passed through substitutions."""
+        return DerivedLayer(name, label, self, substitutions)
+
+    def map_bindings(self, replace, cells=None):
+        """Return (layer, cells changed) with bindings replaced.
+
+        replace is called once per distinct binding and returns its
+        replacement; cells maps (row, col) to a binding set before that.
+        """
+        ids = self.cells
+        if cells:
+            ids = array("H", ids)
+            for (r, c), binding in cells.items():
+                ids[r * self.width + c] = intern_binding(binding)
+        mapping = {i: intern_binding(replace(binding_strings[i])) for i in set(ids)}
+        new = array("H", [mapping[i] for i in ids])
+        changed = sum(a != b for a, b in zip(self.cells, new))
+        return Layer.from_cells(self.name, self.label, self.width, new), changed
+
+    def content_key(self):
+        """Return a hash of the name, label and bindings that does not depend on IDs."""
+        ids = sorted(set(self.cells))
+        return content_hash(self.name, self.label, self.width, self.cells.tobytes(),
+                            [binding_strings[i] for i in ids])
+
+    def column_widths(self):
+        """Return the width of the longest binding in each column."""
+        cells = self.cells
+        lengths = {i: len(binding_strings[i]) for i in set(cells)}
+        return [max(lengths[i] for i in cells[c::self.width]) for c in range(self.width)]
+
+    def __iter__(self):
+        return iter((self.name, self.label, self.grid))
+
+    def __getitem__(self, index):
+        if index in (0, -3):
+            return self.name
+        if index in (1, -2):
+            return self.label
+        return (self.name, self.label, self.grid)[index]
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.name!r}, {self.label!r})"
+
+class DerivedLayer(Layer):
+    """A layer defined as a base layer plus a prefix substitution map.
+
+    Its cells are only materialized the first time they are needed, with
+    each distinct binding of the base substituted once.
+    """
+
+    __slots__ = ("base", "substitutions")
+
+    def __init__(self, name, label, base, substitutions):
+        self.name = name
+        self.label = label
+        self.width = base.width
+        self.base = base
+        self.substitutions = substitutions
+        self._cells = None
+        self._grid = None
+
+    @property
+    def cells(self):
+        if self._cells is None:
+            base_cells = self.base.cells
+            mapping = {i: intern_binding(substitute(binding_strings[i], self.substitutions))
+                       for i in set(base_cells)}
+            self._cells = array("H", [mapping[i] for i in base_cells])
+        return self._cells
+
+def column_widths(grid):
+    """Return the width of the longest binding in each column."""
+    return [max(len(row[c]) for row in grid) for c in range(len(grid[0]))]
+
+def format_row(row, col_widths, split):
+    """Format one grid row. The split column gets +6 padding, others +2."""
+    parts = []
+    last = len(row) - 1
+    for col in range(len(row)):
+        key = row[col]
+        w = col_widths[col]
+        pad = 6 if col == split else 2
+        if col == last:
+            parts.append(key)
+        else:
+            parts.append(f"{key:<{w + pad}}")
+    return "".join(parts).rstrip()
+
+def format_layer(name, label, grid, geometry, col_widths=None):
+    """Format layer from its grid. The split column of geometry gets +6 padding, others +2.
+
+    col_widths, when the caller already has them, saves measuring the grid.
+    """
+    col_widths = col_widths or column_widths(grid)
+    split = geometry.split
 
     return "\n".join([
         f"                {name} {{",
         f'label= "{label}";',
         "bindings = <",
-        fmt_row(0),
-        fmt_row(1),
-        fmt_row(2),
-        fmt_row(3),
+        *[format_row(row, col_widths, split) for row in grid],
         ">;",
         "                };"
     ])
 
-# Layers as (name, label, 14x4 grid)
+def format_macros(groups, multi_line=None):
+    """Format macro groups as behavior-macro nodes.
+
+    Macros named in multi_line (by default the multi-step ones) are written
+    out one property per line; the others take one line each, names aligned
+    per group.
+    """
+    if multi_line is None:
+        multi_line = {name for _, entries in groups for name, bindings in entries
+                      if len(bindings) > 1}
+    lines = ["/ {", "        macros {"]
+    for comment, entries in groups:
+        if not entries:
+            continue
+        if len(lines) > 2:
+            lines.append("")
+        lines.append(f"                // {comment}")
+        w = max((len(name) for name, _ in entries if name not in multi_line), default=0)
+        for name, bindings in entries:
+            cells = ", ".join(f"<{b}>" for b in bindings)
+            if name not in multi_line:
+                lines.append(
+                    f"                {name + ':':<{w + 1}} {name:<{w}} {{ "
+                    f'compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = {cells}; }};'
+                )
+                continue
+            lines += [
+                f"                {name}: {name} {{",
+                '                        compatible = "zmk,behavior-macro";',
+                "                        #binding-cells = <0>;",
+                f"                        bindings = {cells};",
+                "                };",
+            ]
+    lines += [
+        "        };",
+        "",
+        "        keymap {",
+        '                compatible = "zmk,keymap";',
+    ]
+    return "\n".join(lines) + "\n"
+
+def inline_macros(layers, groups, combos=()):
+    """Replace references to single-binding macros with the binding itself.
+
+    A macro wrapping one binding only adds the macro engine's wait/tap delay,
+    so `&k_excl` becomes `&kp LS(N1)`. Layer cells, combo bindings and the
+    steps of the macros that are kept are all rewritten. Macros whose
+    references were inlined are dropped; multi-step and unreferenced macros
+    are kept.
+    Returns (layers, groups, combos, removed) with removed mapping layer name
+    (and "combos" when there are any) to the number of macro invocations
+    replaced.
+    """
+    single = {name: bindings[0] for _, entries in groups
+              for name, bindings in entries if len(bindings) == 1}
+    for name, binding in single.items():
+        # A macro wrapping another single-binding macro inlines to its binding.
+        seen = {name}
+        while binding.startswith("&") and binding[1:] in single and binding[1:] not in seen:
+            seen.add(binding[1:])
+            binding = single[binding[1:]]
+        single[name] = binding
+    inlined = set()
+    removed = {}
+    new_layers = []
+
+    def inline(key):
+        macro = key[1:] if key.startswith("&") else None
+        if macro not in single:
+            return key
+        inlined.add(macro)
+        return single[macro]
+
+    for layer in layers:
+        layer, removed[layer.name] = layer.map_bindings(inline)
+        new_layers.append(layer)
+    new_combos = []
+    for combo in combos:
+        binding = combo[2]
+        macro = binding[1:] if binding.startswith("&") else None
+        if macro in single:
+            combo = (combo[0], combo[1], single[macro]) + tuple(combo[3:])
+            inlined.add(macro)
+            removed["combos"] = removed.get("combos", 0) + 1
+        new_combos.append(combo)
+    new_groups = []
+    for comment, entries in groups:
+        kept = []
+        for name, bindings in entries:
+            if name in inlined:
+                continue
+            steps = []
+            for step in bindings:
+                macro = step[1:] if step.startswith("&") else None
+                if macro in single:
+                    step = single[macro]
+                    inlined.add(macro)
+                steps.append(step)
+            kept.append((name, steps))
+        new_groups.append((comment, kept))
+    new_groups = [(comment, [(n, b) for n, b in entries if n not in inlined])
+                  for comment, entries in new_groups]
+    return new_layers, new_groups, new_combos, removed
+
+def parse_defines(text):
+    """Return {alias: expansion} for the `#define` lines in text."""
+    defines = {}
+    for line in text.splitlines():
+        parts = line.split(None, 2)
+        if len(parts) == 3 and parts[0] == "#define":
+            defines[parts[1]] = parts[2].strip()
+    return defines
+
+def shield_geometry():
+    """Return the key geometry of the shield at SHIELD_PATH (parsed once)."""
+    return load_geometry(SHIELD_PATH)
+
+def check_layers(layers, geometry):
+    """Return messages for layers whose grid does not match the key positions."""
+    errors = []
+    for layer in layers:
+        problem = geometry.check_cells(layer.width, layer.cells)
+        if problem:
+            errors.append(f"{layer.name}: {problem}")
+    return errors
+
+def content_hash(*parts):
+    """Return a stable hex digest of parts (strings, lists, tuples, bytes)."""
+    return hashlib.sha256(repr(parts).encode()).hexdigest()
+
+# Rendered layer text is only reused while format_layer itself is unchanged.
+FORMATTER_HASH = content_hash(*[(f.__code__.co_code, f.__code__.co_consts)
+                                 for f in (column_widths, Layer.column_widths, format_row,
+                                           format_layer)])
+
+def load_cache(path):
+    """Load the regeneration cache, or an empty one if missing or unreadable."""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+@contextlib.contextmanager
+def atomic_writer(path, keep_unchanged=False):
+    """Yield a binary file that replaces path on success, keeping its mode.
+
+    With keep_unchanged, path is left untouched when the new bytes match
+    it; the file's replaced attribute tells whether it was written.
+    """
+    try:
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+        f.replaced = not (keep_unchanged and os.path.exists(path)
+                          and filecmp.cmp(tmp, path, shallow=False))
+        if f.replaced:
+            os.chmod(tmp, mode)
+            os.replace(tmp, path)
+        else:
+            os.unlink(tmp)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def save_cache(path, cache):
+    """Write the regeneration cache to path unless it already holds it."""
+    with atomic_writer(path, keep_unchanged=True) as f:
+        f.write(json.dumps(cache, indent=1).encode())
+
+class KeymapEmitter:
+    """Write the ZMK keymap section by section.
+
+    With a cache, layer text whose inputs are unchanged is reused, the cache
+    is updated in place and changed lists the sections ("header", layer
+    names or "combos") whose text differs from the cached run.
+    """
+
+    needs_keys = False
+
+    def __init__(self, f, geometry, cache=None):
+        self.f = f
+        self.geometry = geometry
+        self.cache = cache
+        self.changed = []
+        self.rendered = {}
+
+    def start(self, head):
+        if self.cache is not None:
+            self.head_hash = content_hash(head)
+            if self.cache.get("header") != self.head_hash:
+                self.changed.append("header")
+        self.f.write(head.encode())
+
+    def render(self, layer):
+        return format_layer(layer.name, layer.label, layer.grid, self.geometry,
+                            layer.column_widths())
+
+    def layer(self, layer, keys):
+        name = layer.name
+        if self.cache is None:
+            text = self.render(layer)
+        else:
+            key = content_hash(FORMATTER_HASH, self.geometry.split, layer.content_key())
+            entry = self.cache.get("layers", {}).get(name)
+            if entry and entry["input"] == key:
+                text = entry["text"]
+            else:
+                text = self.render(layer)
+            out_hash = content_hash(text)
+            if not entry or entry["output"] != out_hash:
+                self.changed.append(name)
+            self.rendered[name] = {"input": key, "output": out_hash, "text": text}
+        self.f.write(b"\n")
+        self.f.write(text.encode())
+        self.f.write(b"\n")
+
+    def end(self, combos):
+        tail = format_combos(combos)
+        self.f.write(footer.encode())
+        self.f.write(tail.encode())
+        if self.cache is None:
+            return
+        if self.cache.get("tail") != content_hash(tail):
+            self.changed.append("combos")
+        self.changed += [name for name in self.cache.get("layers", {}) if name not in self.rendered]
+        self.cache.update(header=self.head_hash, tail=content_hash(tail),
+                          layers=self.rendered)
+
+def emit_keymap(emitters, head, layers, geometry, combos=()):
+    """Walk the keymap model once, feeding every emitter section by section.
+
+    head is the header with its macro nodes and layers are Layer objects.
+    When an emitter needs them, each layer's bindings are resolved through
+    the header #defines once and handed over in key-position order as
+    (row, col, binding, resolved) tuples.
+    """
+    resolve = any(e.needs_keys for e in emitters)
+    defines = parse_defines(head) if resolve else {}
+    for e in emitters:
+        e.start(head)
+    for layer in layers:
+        keys = None
+        if resolve:
+            grid = layer.grid
+            keys = [(r, c, grid[r][c], defines.get(grid[r][c], grid[r][c]))
+                    for r, c in geometry.cells]
+        for e in emitters:
+            e.layer(layer, keys)
+    for e in emitters:
+        e.end(combos)
+
+def write_outputs(paths, head, layers, groups, geometry, combos=(), cache=None):
+    """Write the keymap and the requested exports in one pass over the layers.
+
+    paths maps "keymap", "json" and "svg" to output paths; a missing or None
+    path skips that output. Files whose bytes did not change are left alone.
+    Returns (written paths, changed keymap sections, {path: bytes rendered});
+    no sections are reported as changed when the keymap file was left alone.
+    """
+    with contextlib.ExitStack() as stack:
+        files = {kind: stack.enter_context(atomic_writer(path, keep_unchanged=True))
+                 for kind, path in paths.items() if path}
+        keymap = KeymapEmitter(files["keymap"], geometry, cache)
+        emitters = [keymap]
+        if "json" in files:
+            emitters.append(JsonEmitter(files["json"], groups))
+        if "svg" in files:
+            emitters.append(SvgEmitter(files["svg"], len(layers), geometry))
+        emit_keymap(emitters, head, layers, geometry, combos)
+        sizes = {paths[kind]: f.tell() for kind, f in files.items()}
+    written = [paths[kind] for kind, f in files.items() if f.replaced]
+    return written, keymap.changed if files["keymap"].replaced else [], sizes
+
+# Rough firmware cost model (32-bit target): each binding is a
+# zmk_behavior_binding (device name pointer + two params), each macro is a
+# behavior device with its config and RAM state, each combo a config with
+# its binding and key position list.
+BINDING_BYTES = 12
+MACRO_DEVICE_BYTES = 40
+MACRO_STATE_BYTES = 16
+COMBO_BYTES = 16
+LAYER_BEHAVIORS = ("&to", "&mo", "&lt", "&tog", "&sl")
+
+def reachability(layers, groups, defines, combos=()):
+    """Return (reachable layer names, referenced macro names).
+
+    Layers are reached from the default layer (index 0) through &to, &mo,
+    &lt, &tog and &sl bindings, directly, via aliases or inside macros.
+    Macros count as referenced when a reachable layer, a combo active on one
+    or another referenced macro uses them.
+    """
+    steps = {name: bindings for _, entries in groups for name, bindings in entries}
+    by_index = {str(i): name for i, (name, _, _) in enumerate(layers)}
+    layers_by_name = {name: grid for name, _, grid in layers}
+    used_macros = set()
+
+    def targets(binding):
+        tokens = defines.get(binding, binding).split()
+        if not tokens:
+            return
+        if tokens[0] in LAYER_BEHAVIORS and len(tokens) > 1:
+            target = by_index.get(defines.get(tokens[1], tokens[1]))
+            if target:
+                yield target
+        macro = tokens[0][1:]
+        if macro in steps and macro not in used_macros:
+            used_macros.add(macro)
+            for step in steps[macro]:
+                yield from targets(step)
+
+    def layer_bindings(name):
+        for row in layers_by_name[name]:
+            yield from row
+        for _, _, binding, combo_layers, _ in combos:
+            if combo_layers is None or name in combo_layers:
+                yield binding
+
+    reached = {layers[0][0]} if layers else set()
+    queue = list(reached)
+    while queue:
+        for key in layer_bindings(queue.pop()):
+            for target in targets(key):
+                if target not in reached:
+                    reached.add(target)
+                    queue.append(target)
+    return reached, used_macros
+
+def prune_unused(layers, groups, head, combos, geometry):
+    """Drop layers that cannot be reached and macros nothing reachable uses.
+
+    geometry is the key geometry the layer grids follow. Returns (layers,
+    groups, head, report) with report listing the pruned "layers" and
+    "macros".
+    """
+    reached, _ = reachability(layers, groups, parse_defines(head), combos)
+    dead_layers = [name for name, _, _ in layers if name not in reached]
+    if dead_layers:
+        layers, groups, head = apply_spec(layers, groups, head, {"drop_layers": dead_layers},
+                                          geometry)
+    _, used = reachability(layers, groups, parse_defines(head), combos)
+    dead_macros = [name for _, entries in groups for name, _ in entries if name not in used]
+    groups = [(comment, [(n, b) for n, b in entries if n in used]) for comment, entries in groups]
+    return layers, groups, head, {"layers": dead_layers, "macros": dead_macros}
+
+def estimate_footprint(layers, groups, combos=()):
+    """Estimate devicetree nodes and binding/macro bytes of a keymap.
+
+    Nodes are the root, macros and keymap containers plus one per macro and
+    per layer, and a combos container plus one per resolved combo; bytes
+    follow the cost model above.
+    """
+    entries = [bindings for _, group in groups for _, bindings in group]
+    positions = sum(1 for _, _, grid in layers for row in grid for key in row if key)
+    steps = sum(len(bindings) for bindings in entries)
+    combo_keys = sum(len(combo[1]) for combo in combos)
+    return {
+        "nodes": 3 + len(entries) + len(layers) + (1 + len(combos) if combos else 0),
+        "bytes": (positions + steps + len(combos)) * BINDING_BYTES
+                 + len(entries) * (MACRO_DEVICE_BYTES + MACRO_STATE_BYTES)
+                 + len(combos) * COMBO_BYTES + combo_keys * 4,
+    }
+
+def over_budget(footprint, max_nodes=None, max_bytes=None):
+    """Return messages for each limit the footprint exceeds."""
+    over = []
+    if max_nodes is not None and footprint["nodes"] > max_nodes:
+        over.append(f"{footprint['nodes']} devicetree nodes exceed the budget of {max_nodes}")
+    if max_bytes is not None and footprint["bytes"] > max_bytes:
+        over.append(f"{footprint['bytes']} estimated bytes exceed the budget of {max_bytes}")
+    return over
+
+# ZMK's default CONFIG_ZMK_COMBO_MAX_COMBOS_PER_KEY and _MAX_KEYS_PER_COMBO
+COMBOS_PER_KEY = 5
+KEYS_PER_COMBO = 4
+
+def resolve_combos(combos, layers, geometry, all_layers):
+    """Map combo grid cells to key positions and layer names to #define names.
+
+    Cells are looked up in the key geometry. all_layers is the layer table
+    before pruning: layers in it but not in layers are left out and combos
+    left without any layer are dropped. Returns [(name, positions, binding,
+    layer consts or None, timeout)]; raises ValueError for layer names not in
+    all_layers, cells that are not keys and combos with too few or too many
+    keys.
+    """
+    position = geometry.positions
+    known = {name for name, _, _ in all_layers}
+    consts = {name: layer_const(label) for name, label, _ in layers}
+    resolved = []
+    for name, combo_cells, binding, combo_layers, timeout in combos:
+        unknown = [n for n in combo_layers or () if n not in known]
+        if unknown:
+            raise ValueError(f"{name}: unknown layers {unknown}")
+        missing = [cell for cell in combo_cells if tuple(cell) not in position]
+        if missing:
+            raise ValueError(f"{name}: cells {missing} are not key positions")
+        if not 2 <= len(combo_cells) <= KEYS_PER_COMBO:
+            raise ValueError(f"{name}: combos need 2 to {KEYS_PER_COMBO} keys")
+        if combo_layers is not None:
+            combo_layers = [consts[n] for n in combo_layers if n in consts]
+            if not combo_layers:
+                continue
+        positions = sorted(position[tuple(cell)] for cell in combo_cells)
+        resolved.append((name, positions, binding, combo_layers, timeout))
+    return resolved
+
+def combo_report(resolved, per_key=COMBOS_PER_KEY):
+    """Analyse resolved combos per key position.
+
+    Returns (stats, errors, warnings) with stats mapping each key position
+    used by a combo to (combo count, worst-case added delay in ms): ZMK holds
+    back a press on such a key for up to the longest timeout of its combos.
+    Keys in more than per_key combos are errors; a combo whose keys are a
+    subset of another on a shared layer always waits out the timeout, which
+    is a warning.
+    """
+    stats = {}
+    for _, positions, _, _, timeout in resolved:
+        for pos in positions:
+            count, delay = stats.get(pos, (0, 0))
+            stats[pos] = (count + 1, max(delay, timeout))
+    errors = [f"key position {pos} is in {count} combos (budget {per_key})"
+              for pos, (count, _) in sorted(stats.items()) if count > per_key]
+    warnings = []
+    for name_a, pos_a, _, layers_a, _ in resolved:
+        for name_b, pos_b, _, layers_b, timeout_b in resolved:
+            shared = layers_a is None or layers_b is None or set(layers_a) & set(layers_b)
+            if name_a == name_b or not shared:
+                continue
+            if pos_a == pos_b:
+                errors.append(f"{name_a} and {name_b} use the same keys")
+            elif set(pos_a) < set(pos_b):
+                warnings.append(f"{name_a} is part of {name_b} and waits {timeout_b} ms for it")
+    return stats, sorted(set(errors)), warnings
+
+def format_combos(resolved):
+    """Format resolved combos as a root node block, or "" when there are none."""
+    if not resolved:
+        return ""
+    lines = ["", "/ {", "        combos {", '                compatible = "zmk,combos";']
+    for name, positions, binding, combo_layers, timeout in resolved:
+        lines += [
+            f"                {name} {{",
+            f"                        timeout-ms = <{timeout}>;",
+            f"                        key-positions = <{' '.join(map(str, positions))}>;",
+            f"                        bindings = <{binding}>;",
+        ]
+        if combo_layers is not None:
+            lines.append(f"                        layers = <{' '.join(combo_layers)}>;")
+        lines.append("                };")
+    lines += ["        };", "};"]
+    return "\n".join(lines) + "\n"
+
+def set_defines(text, values):
+    """Return text with the `#define` expansions in values replaced.
+
+    A value of None removes the define. Raises ValueError for names that
+    are not defined in text.
+    """
+    missing = set(values)
+    lines = []
+    for line in text.split("\n"):
+        parts = line.split(None, 2)
+        if len(parts) == 3 and parts[0] == "#define" and parts[1] in values:
+            missing.discard(parts[1])
+            if values[parts[1]] is None:
+                continue
+            line = f"#define {parts[1]} {values[parts[1]]}"
+        lines.append(line)
+    if missing:
+        raise ValueError(f"Unknown defines: {', '.join(sorted(missing))}")
+    return "\n".join(lines)
+
+def layer_const(label):
+    """Return the `#define` name of a layer index, e.g. "COLEMAK PC" -> COLEMAK_PC."""
+    return label.replace(" ", "_")
+
+def apply_spec(layers, groups, head, spec, geometry):
+    """Apply a variant spec on top of the base layers, macros and header.
+
+    A spec is a dict with optional keys:
+      "drop_layers": layer names to leave out; remaining layer indices are
+                     renumbered and anything that reaches a dropped layer
+                     (aliases, macro steps, cells) is removed or set to &none
+      "defines":     {alias: expansion} overrides, e.g. a different hm_* order
+      "cells":       {layer name: [[row, col, binding], ...]}
+    Returns (layers, groups, head).
+    """
+    dropped = set(spec.get("drop_layers", ()))
+    names = {name for name, _, _ in layers}
+    unknown = (dropped | set(spec.get("cells", {}))) - names
+    if unknown:
+        raise ValueError(f"Unknown layers: {', '.join(sorted(unknown))}")
+
+    values = dict(spec.get("defines", {}))
+    kept = [layer for layer in layers if layer[0] not in dropped]
+    defines = parse_defines(set_defines(head, values))
+    for index, (_, label, _) in enumerate(kept):
+        if layer_const(label) in defines:
+            values.setdefault(layer_const(label), str(index))
+    dead = {layer_const(label) for name, label, _ in layers if name in dropped}
+    dead |= {alias for alias, expansion in defines.items() if dead & set(expansion.split())}
+    for alias in dead & set(defines):
+        values[alias] = None
+    head = set_defines(head, values)
+
+    def reaches_dead(binding):
+        return bool(dead & set(binding.split()))
+
+    groups = [(comment, [(n, [b for b in bindings if not reaches_dead(b)] or ["&none"])
+                         for n, bindings in entries])
+              for comment, entries in groups]
+    cells = spec.get("cells", {})
+    new_layers = []
+    for layer in kept:
+        changes = {}
+        for r, c, binding in cells.get(layer.name, ()):
+            if (r, c) not in geometry.positions:
+                raise ValueError(f"{layer.name}: cell ({r}, {c}) is not a key position")
+            changes[(r, c)] = binding
+        layer, _ = layer.map_bindings(lambda key: "&none" if reaches_dead(key) else key, changes)
+        new_layers.append(layer)
+    return new_layers, groups, head
+
+def render_variant(job):
+    """Render one spec file to out_dir.
+
+    exports names the extra outputs ("json", "svg") written next to the
+    keymap under the same stem. Returns (keymap path, bytes rendered, bytes
+    written); outputs whose bytes did not change are not written.
+    """
+    spec_path, out_dir, inline, prune, budget, per_key, exports, shield = job
+    with open(spec_path) as f:
+        spec = json.load(f)
+    geometry = load_geometry(shield)
+    # The spec edits the base tables, so cells it sets to a macro are inlined
+    # or keep their macro node like any other reference.
+    variant_layers, variant_macros, head = apply_spec(layers, macros, header, spec, geometry)
+    combo_table = combos
+    if inline:
+        variant_layers, variant_macros, combo_table, _ = inline_macros(
+            variant_layers, variant_macros, combo_table)
+    if prune:
+        variant_layers, variant_macros, head, _ = prune_unused(
+            variant_layers, variant_macros, head, combo_table, geometry)
+    variant_combos = resolve_combos(combo_table, variant_layers, geometry, layers)
+    _, errors, _ = combo_report(variant_combos, per_key)
+    over = errors + over_budget(estimate_footprint(variant_layers, variant_macros, variant_combos),
+                                *budget)
+    if over:
+        raise ValueError("; ".join(over))
+    head += format_macros(variant_macros)
+    stem = os.path.splitext(os.path.basename(spec_path))[0]
+    path = os.path.join(out_dir, spec.get("output", stem + ".keymap"))
+    paths = {"keymap": path}
+    paths.update((kind, os.path.splitext(path)[0] + "." + kind) for kind in exports)
+    written, _, sizes = write_outputs(paths, head, variant_layers, variant_macros, geometry,
+                                      variant_combos)
+    return path, sum(sizes.values()), sum(sizes[p] for p in written)
+
+def run_batch(spec_dir, out_dir, inline=True, prune=True, budget=(None, None),
+              per_key=COMBOS_PER_KEY, jobs=None, exports=(), shield=None):
+    """Render every *.json spec in spec_dir in parallel and print a summary.
+
+    Returns the number of specs that failed.
+    """
+    specs = sorted(os.path.join(spec_dir, n) for n in os.listdir(spec_dir) if n.endswith(".json"))
+    os.makedirs(out_dir, exist_ok=True)
+    start = time.perf_counter()
+    rendered = written = failed = 0
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        work = [(spec, out_dir, inline, prune, budget, per_key, exports, shield or SHIELD_PATH)
+                for spec in specs]
+        futures = [(job[0], pool.submit(render_variant, job)) for job in work]
+        for spec, future in futures:
+            try:
+                _, size, written_size = future.result()
+            except (OSError, ValueError, json.JSONDecodeError) as e:
+                print(f"  {spec}: {e}")
+                failed += 1
+                continue
+            rendered += size
+            written += written_size
+    elapsed = time.perf_counter() - start
+    done = len(specs) - failed
+    print(f"Rendered {done}/{len(specs)} variants to {out_dir} in {elapsed:.2f}s "
+          f"({done / elapsed if elapsed else 0:.1f} variants/s, {rendered} bytes rendered, "
+          f"{written} written)")
+    return failed
+
+def format_layer_source(name, label, grid):
+    """Format a layer as an entry of the `layers` table."""
+    quoted = [[f'"{key}",' for key in row] for row in grid]
+    widths = column_widths(quoted)
+    lines = [f'    Layer("{name}", "{label}", [']
+    for row in quoted:
+        cells = [f"{key:<{widths[c] + 1}}" for c, key in enumerate(row[:-1])] + [row[-1][:-1]]
+        lines.append("        [" + "".join(cells).rstrip() + "],")
+    lines.append("    ]),")
+    return "\n".join(lines)
+
+def format_macros_source(groups):
+    """Format macro groups as the `macros` table."""
+    lines = ["macros = ["]
+    for comment, entries in groups:
+        lines.append(f'    ("{comment}", [')
+        w = max((len(name) for name, _ in entries), default=0)
+        for name, bindings in entries:
+            quoted = ", ".join(f'"{b}"' for b in bindings)
+            lines.append(f'        ({f"{chr(34)}{name}{chr(34)},":<{w + 3}} [{quoted}]),')
+        lines.append("    ]),")
+    lines.append("]")
+    return "\n".join(lines)
+
+def split_bindings(text, defines):
+    """Split a bindings list into bindings.
+
+    A binding starts at a `&behavior` token or at an alias that expands to
+    one (hm_a, pcl_sh, ...); other tokens are parameters of the binding
+    before them.
+    """
+    bindings = []
+    for token in text.split():
+        if token.startswith("&") or defines.get(token, "").startswith("&") or not bindings:
+            bindings.append(token)
+        else:
+            bindings[-1] += " " + token
+    return bindings
+
+def strip_comments(line, in_comment=False):
+    """Return (line without // and /* */ comments, whether a /* is still open)."""
+    code = []
+    while line:
+        if in_comment:
+            end = line.find("*/")
+            if end < 0:
+                break
+            line = line[end + 2:]
+            in_comment = False
+            continue
+        start = min((i for i in (line.find("//"), line.find("/*")) if i >= 0), default=-1)
+        if start < 0:
+            code.append(line)
+            break
+        code.append(line[:start])
+        if line.startswith("//", start):
+            break
+        line = line[start + 2:]
+        in_comment = True
+    return "".join(code), in_comment
+
+def iter_keymap(lines, geometry):
+    """Parse keymap lines in one pass, yielding sections as they complete.
+
+    Yields (kind, raw, value) where raw is the exact source text of the
+    section and value is:
+      "header": {alias: expansion} of its #define lines
+      "macros": (macro groups in the `macros` table format, names of the
+                 macro nodes spread over several lines)
+      "layer":  (name, label, grid)
+      "footer": combos after the keymap node, as resolve_combos returns them
+    Bindings are placed on the grid cells of their key positions in
+    geometry. Only one section is held in memory at a time.
+    """
+    raw = []
+    state = "header"
+    defines = {}
+    groups = []
+    multi_line = set()
+    depth = 0
+    node = []
+    in_comment = False
+    for line in lines:
+        line = line.rstrip("\n")
+        stripped = line.strip()
+        if state == "header":
+            if stripped == "/ {":
+                text = "".join(raw)
+                defines = parse_defines(text)
+                yield "header", text, defines
+                raw = []
+                state = "macros"
+            raw.append(line + "\n")
+            continue
+        raw.append(line + "\n")
+        if state == "macros" and stripped.startswith("//"):
+            groups.append((stripped[2:].strip(), []))
+            continue
+        code, in_comment = strip_comments(line, in_comment)
+        stripped = code.strip()
+        if state == "macros":
+            if stripped == 'compatible = "zmk,keymap";':
+                yield "macros", "".join(raw), (groups, multi_line)
+                raw = []
+                state = "layers"
+            elif node or ":" in stripped and "{" in stripped:
+                # A macro node, on one line or spread over several.
+                node.append(stripped)
+                depth += stripped.count("{") - stripped.count("}")
+                if depth == 0:
+                    text = " ".join(node)
+                    bindings = text.split("bindings =", 1)[1].split(";", 1)[0]
+                    if not groups:
+                        groups.append(("", []))
+                    name = text.split(":", 1)[0].strip()
+                    groups[-1][1].append((name, re.findall(r"<([^>]*)>", bindings)))
+                    if len(node) > 1:
+                        multi_line.add(name)
+                    node = []
+            continue
+        depth += stripped.count("{") - stripped.count("}")
+        if depth < 0:
+            # Closing brace of the keymap node: the rest is the footer.
+            state = "footer"
+            depth = 0
+        if state == "footer":
+            continue
+        node.append(stripped)
+        if depth == 0 and node and node[0].endswith("{"):
+            yield "layer", "".join(raw), parse_layer_node(node, defines, geometry)
+            raw = []
+            node = []
+        elif depth == 0:
+            node = []
+    if state == "footer":
+        text = "".join(raw)
+        yield "footer", text, parse_combos(text)
+    elif raw:
+        raise ValueError(f"Unexpected end of keymap in {state} section")
+
+def parse_layer_node(node, defines, geometry):
+    """Return (name, label, grid) for the lines of one layer node."""
+    name = node[0][:-1].strip()
+    text = " ".join(node[1:-1])
+    label = ""
+    if "label" in text:
+        label = text.split("label", 1)[1].split('"', 2)[1]
+    bindings = split_bindings(text.split("bindings", 1)[1].split("<", 1)[1].split(">;", 1)[0],
+                              defines)
+    if len(bindings) != len(geometry):
+        raise ValueError(f"{name}: expected {len(geometry)} bindings, found {len(bindings)}")
+    grid = geometry.empty_grid()
+    for (r, c), binding in zip(geometry.cells, bindings):
+        grid[r][c] = binding
+    return name, label, grid
+
+def parse_combos(text):
+    """Return the combo nodes in text in the form resolve_combos returns."""
+    resolved = []
+    for name, body in re.findall(r"^\s*(\w+) \{\n([^{}]*?)^\s*\};", text, re.M):
+        if "key-positions" not in body:
+            continue
+        props = dict(re.findall(r"([\w-]+) = <([^>]*)>;", body))
+        combo_layers = props["layers"].split() if "layers" in props else None
+        resolved.append((name, [int(p) for p in props["key-positions"].split()],
+                         props["bindings"], combo_layers, int(props["timeout-ms"])))
+    return resolved
+
+def render_section(kind, value, raw, geometry):
+    """Re-emit a parsed section the way the generator writes it."""
+    if kind == "header":
+        return raw
+    if kind == "macros":
+        return format_macros(*value)
+    if kind == "layer":
+        return "\n" + format_layer(*value, geometry) + "\n"
+    return footer + format_combos(value)
+
+def check_keymap(path, geometry):
+    """Return None if path re-emits byte-identically, else the first differing section.
+
+    The header and footer are kept verbatim and macro nodes keep their
+    one-line or multi-line form, but the macros block and layer nodes must
+    be laid out the way the generator writes them: this checks keymaps the
+    generator wrote (or was meant to write), not hand-formatted ones.
+    """
+    with open(path) as f:
+        for kind, raw, value in iter_keymap(f, geometry):
+            if render_section(kind, value, raw, geometry) != raw:
+                return value[0] if kind == "layer" else kind
+    return None
+
+def start_profiling(prefix):
+    """Profile the rest of the run; at exit dump cProfile stats and a tracemalloc snapshot."""
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+
+    def dump():
+        profiler.disable()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(prefix + ".prof")
+        snapshot.dump(prefix + ".mem")
+        print(f"Profile written to {prefix}.prof and {prefix}.mem "
+              f"(peak traced memory {peak / 1024:.0f} KiB)", file=sys.stderr)
+
+    atexit.register(dump)
+    profiler.enable()
+
+def build(spec, args, cache, paths):
+    """Run the generation pipeline on the tables in spec and write paths.
+
+    spec maps "layers", "macros", "header" and "combos" to the tables below
+    and "SHIELD_PATH" to the shield whose geometry they follow (the module
+    globals, or a reloaded copy in watch mode); args.shield overrides it.
+    paths is as for write_outputs. Returns (written paths, changed sections,
+    report lines, emitted layers); raises ValueError for layers that do not
+    match the geometry, invalid combos or an exceeded size budget, before
+    anything is written.
+    """
+    report = []
+    geometry = load_geometry(args.shield or spec["SHIELD_PATH"])
+    mismatched = check_layers(spec["layers"], geometry)
+    if mismatched:
+        raise ValueError("Layers do not match the shield geometry: " + "; ".join(mismatched))
+    out_layers, out_macros, out_header = spec["layers"], spec["macros"], spec["header"]
+    combo_table = spec["combos"]
+    try:
+        base_combos = resolve_combos(combo_table, out_layers, geometry, spec["layers"])
+    except ValueError as e:
+        raise ValueError(f"Invalid combo: {e}") from None
+    before = estimate_footprint(out_layers, out_macros, base_combos)
+    if not args.no_inline:
+        out_layers, out_macros, combo_table, removed = inline_macros(out_layers, out_macros,
+                                                                     combo_table)
+        report.append(f"Inlined {sum(removed.values())} macro invocations:")
+        report += [f"  {name}: {count}" for name, count in removed.items() if count]
+    if not args.no_prune:
+        out_layers, out_macros, out_header, pruned = prune_unused(
+            out_layers, out_macros, out_header, combo_table, geometry)
+        report += [f"Pruned {kind}: {', '.join(names)}" for kind, names in pruned.items() if names]
+
+    cells = geometry.cells
+    out_combos = resolve_combos(combo_table, out_layers, geometry, spec["layers"])
+    stats, errors, warnings = combo_report(out_combos, args.combos_per_key)
+    report += [f"Combo key {pos} {cells[pos]}: {count} combo(s), presses wait up to {delay} ms"
+               for pos, (count, delay) in sorted(stats.items())]
+    report += [f"Warning: {warning}" for warning in warnings]
+    if errors:
+        raise ValueError("Combo budget exceeded: " + "; ".join(errors))
+
+    after = estimate_footprint(out_layers, out_macros, out_combos)
+    report.append(f"Footprint: {before['nodes']} -> {after['nodes']} devicetree nodes, "
+                  f"{before['bytes']} -> {after['bytes']} estimated bytes")
+    over = over_budget(after, args.max_nodes, args.max_bytes)
+    if over:
+        raise ValueError("Size budget exceeded: " + "; ".join(over))
+
+    written, changed, _ = write_outputs(paths, out_header + format_macros(out_macros), out_layers,
+                                        out_macros, geometry, out_combos, cache)
+    return written, changed, report, out_layers
+
+# inotify_event: int wd; uint32_t mask, cookie, len; char name[len]
+def output_paths(args):
+    """Return the write_outputs paths selected by the command-line arguments."""
+    return {"keymap": KEYMAP_PATH, "json": None if args.no_json else args.json,
+            "svg": None if args.no_svg else args.svg}
+
+def watch(path, args):
+    """Regenerate the keymap on each save of path or the shield, keeping the last good output.
+
+    The render cache is loaded once and saved after each run, so only layers
+    whose inputs changed are re-rendered; the shield geometry is re-read on
+    every run. An edit that fails to load or validate is reported and the
+    keymap on disk is left as it was.
+    """
+    cache = None if args.no_cache else load_cache(CACHE_PATH)
+    shield = args.shield or SHIELD_PATH
+    print(f"Watching {path} and {shield} (Ctrl-C to stop)")
+    changes = watch_changes([path, shield, layout_path(shield)])
+    try:
+        for _ in itertools.chain([None], changes):
+            start = time.perf_counter()
+            load_geometry.cache_clear()
+            try:
+                spec = runpy.run_path(path, run_name="keymap_spec")
+                written, changed, _, _ = build(spec, args, cache, output_paths(args))
+            except Exception as e:  # the spec is arbitrary Python being edited
+                print(f"Keeping previous {KEYMAP_PATH}: {type(e).__name__}: {e}")
+                continue
+            if cache is not None:
+                save_cache(CACHE_PATH, cache)
+            elapsed = (time.perf_counter() - start) * 1000
+            print(f"{'Updated ' + ', '.join(written) if written else 'Unchanged'} in {elapsed:.1f} ms"
+                  + (f" ({', '.join(changed)})" if changed else ""))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        changes.close()
+
+# Mac layers are the PC ones with PC shortcut macros and layer-taps swapped
+PC_TO_MAC = {"&pc_": "&mc_", "pcl_": "mcl_"}
+
+# Layers with a Mac twin; the Mac layers are derived from them below.
+colemak_pc = Layer("colemak_pc_layer", "COLEMAK PC", [
+    ["",          "&kp Q", "&kp W", "&kp F", "&kp P",   "&kp B",   "",        "",        "&kp J",   "&kp L",   "&kp U",     "&kp Y",   "&kp SQT",  ""],
+    ["",          "hm_a",  "hm_r",  "hm_s",  "hm_t",    "&kp G",   "",        "",        "&kp M",   "hm_n",    "hm_e",      "hm_i",    "hm_o",     ""],
+    ["&kp LSHFT", "&kp Z", "&kp X", "&kp C", "&kp D",   "&kp V",   "",        "",        "&kp K",   "&kp H",   "&kp COMMA", "&kp DOT", "&kp FSLH", "mo_bt"],
+    ["",          "",      "",      "",      "pcl_sh",  "pcl_br",  "pcl_na",  "pcl_nu",  "pcl_sy",  "pcl_fn",  "",          "",        "",         ""],
+])
+
+brackets_pc = Layer("brackets_pc_layer", "BRACKETS PC", [
+    ["",       "&kp LBKT",  "&kp RBKT", "&k_lt",   "&k_gt",   "&k_coln",   "",      "",      "&k_coln",   "&k_lt",   "&k_gt",   "&kp LBKT", "&kp RBKT",  ""],
+    ["",       "&k_lcrl",   "&k_rcrl",  "&k_lprn", "&k_rprn", "&kp SEMI",  "",      "",      "&kp SEMI",  "&k_lprn", "&k_rprn", "&k_lcrl",  "&k_rcrl",   ""],
+    ["&trans", "&kp GRAVE", "&kp SQT",  "&k_dquo", "&k_excl", "&kp EQUAL", "",      "",      "&kp EQUAL", "&k_excl", "&k_dquo", "&kp SQT",  "&kp GRAVE", "&trans"],
+    ["",       "",          "",         "",        "&none",   "&none",     "&none", "&none", "&pc_dlwd",  "&pc_dlwf", "",        "",         "",          ""],
+])
+
+navigation_pc = Layer("navigation_pc_layer", "NAVIGATION PC", [
+    ["",       "&pc_undo", "&pc_cut",   "&pc_copy",  "&pc_pste", "&pc_redo", "",      "",      "&pc_gobk", "&pc_wdlf", "&pc_gtbr", "&pc_gtbr", "&pc_wdrt",  ""],
+    ["",       "&kp HOME", "&kp PG_DN", "&kp PG_UP", "&kp END",  "&pc_prnt", "",      "",      "&pc_prnt", "&kp LEFT", "&kp DOWN", "&kp UP",   "&kp RIGHT", ""],
+    ["&trans", "&pc_gtln", "&pc_zmbk",  "&pc_zmfw",  "&pc_swfl", "&pc_palt", "",      "",      "&pc_palt", "&pc_swfl", "&pc_zmfw", "&pc_zmbk", "&pc_gtln",  "&trans"],
+    ["",       "",         "",          "",          "&pc_slal", "&pc_save", "&none", "&none", "&pc_dlls", "&pc_dlle", "",         "",         "",          ""],
+])
+
+shortcuts_pc = Layer("shortcuts_pc_layer", "SHORTCUTS PC", [
+    ["",       "&pc_scrn", "&pc_cmnt", "&pc_rpfl", "&pc_fnfl", "&pc_zmin", "",       "",       "&pc_zmin", "&pc_fnfl", "&pc_rpfl", "&pc_cmnt", "&pc_scrn", ""],
+    ["",       "&pc_shot", "&pc_frmt", "&pc_rplc", "&pc_find", "&pc_zmot", "",       "",       "&pc_zmot", "&pc_find", "&pc_rplc", "&pc_frmt", "&pc_shot", ""],
+    ["&trans", "&pc_srec", "&pc_gdef", "&pc_gimp", "&pc_qfix", "&pc_ctab", "",       "",       "&pc_ctab", "&pc_qfix", "&pc_gimp", "&pc_gdef", "&pc_srec", "&trans"],
+    ["",       "",         "",         "",         "&trans",   "&trans",   "&trans", "&trans", "&trans",   "&trans",   "",         "",         "",         ""],
+])
+
+# Layers as Layer(name, label, grid) or derived from a PC layer; grids follow
+# the transform map in SHIELD_PATH, with "" where the shield has no key
 # Grid columns: 0=outer_l, 1-5=left, 6=thumb_l3, 7=thumb_r1, 8-12=right, 13=outer_r
 layers = [
-    ("colemak_pc_layer", "COLEMAK PC", [
-        ["",          "&kp Q", "&kp W", "&kp F", "&kp P",   "&kp B",   "",        "",        "&kp J",   "&kp L",   "&kp U",     "&kp Y",   "&kp SQT",  ""],
-        ["",          "hm_a",  "hm_r",  "hm_s",  "hm_t",    "&kp G",   "",        "",        "&kp M",   "hm_n",    "hm_e",      "hm_i",    "hm_o",     ""],
-        ["&kp LSHFT", "&kp Z", "&kp X", "&kp C", "&kp D",   "&kp V",   "",        "",        "&kp K",   "&kp H",   "&kp COMMA", "&kp DOT", "&kp FSLH", "mo_bt"],
-        ["",          "",      "",      "",      "pcl_sh",  "pcl_br",  "pcl_na",  "pcl_nu",  "pcl_sy",  "pcl_fn",  "",          "",        "",         ""],
-    ]),
-    ("colemak_mac_layer", "COLEMAK MAC", [
-        ["",          "&kp Q", "&kp W", "&kp F", "&kp P",   "&kp B",   "",        "",        "&kp J",   "&kp L",   "&kp U",     "&kp Y",   "&kp SQT",  ""],
-        ["",          "hm_a",  "hm_r",  "hm_s",  "hm_t",    "&kp G",   "",        "",        "&kp M",   "hm_n",    "hm_e",      "hm_i",    "hm_o",     ""],
-        ["&kp LSHFT", "&kp Z", "&kp X", "&kp C", "&kp D",   "&kp V",   "",        "",        "&kp K",   "&kp H",   "&kp COMMA", "&kp DOT", "&kp FSLH", "mo_bt"],
-        ["",          "",      "",      "",      "mcl_sh",  "mcl_br",  "mcl_na",  "mcl_nu",  "mcl_sy",  "mcl_fn",  "",          "",        "",         ""],
-    ]),
-    ("qwerty_gaming_layer", "QWERTY GAMING", [
+    colemak_pc,
+    colemak_pc.derive("colemak_mac_layer", "COLEMAK MAC", PC_TO_MAC),
+    Layer("qwerty_gaming_layer", "QWERTY GAMING", [
         ["",         "&kp Q", "&kp W", "&kp E", "&kp R",   "&kp T",     "",        "",        "&kp Y",    "&kp U",   "&kp I",     "&kp O",   "&kp P",    ""],
         ["",         "&kp A", "&kp S", "&kp D", "&kp F",   "&kp G",     "",        "",        "&kp H",    "&kp J",   "&kp K",     "&kp L",   "&kp SEMI", ""],
         ["&kp LGUI", "&kp Z", "&kp X", "&kp C", "&kp V",   "&kp B",     "",        "",        "&kp N",    "&kp M",   "&kp COMMA", "&kp DOT", "&kp FSLH", "mo_bt"],
         ["",         "",      "",      "",      "&kp ESC", "&kp SPACE", "&kp TAB", "&kp RET", "&kp BSPC", "&kp DEL", "",          "",        "",         ""],
     ]),
-    ("symbols_layer", "SYMBOLS", [
+    Layer("symbols_layer", "SYMBOLS", [
         ["",       "&k_at",   "&k_dllr", "&k_hash",   "&k_pcnt",  "&k_star",  "",      "",      "&k_star",  "&k_pcnt",  "&k_hash",   "&k_dllr", "&k_at",   ""],
         ["",       "&k_ampr", "&k_pipe", "&k_cart",   "&kp BSLH", "&kp FSLH", "",      "",      "&kp FSLH", "&kp BSLH", "&k_cart",   "&k_pipe", "&k_ampr", ""],
         ["&trans", "&k_tild", "&k_plus", "&kp MINUS", "&k_undr",  "&k_ques",  "",      "",      "&k_ques",  "&k_undr",  "&kp MINUS", "&k_plus", "&k_tild", "&trans"],
         ["",       "",        "",        "",          "&none",    "&none",    "&none", "&none", "&none",    "&none",    "",          "",        "",        ""],
     ]),
-    ("brackets_pc_layer", "BRACKETS PC", [
-        ["",       "&kp LBKT",  "&kp RBKT", "&k_lt",   "&k_gt",   "&k_coln",   "",      "",      "&k_coln",   "&k_lt",   "&k_gt",   "&kp LBKT", "&kp RBKT",  ""],
-        ["",       "&k_lcrl",   "&k_rcrl",  "&k_lprn", "&k_rprn", "&kp SEMI",  "",      "",      "&kp SEMI",  "&k_lprn", "&k_rprn", "&k_lcrl",  "&k_rcrl",   ""],
-        ["&trans", "&kp GRAVE", "&kp SQT",  "&k_dquo", "&k_excl", "&kp EQUAL", "",      "",      "&kp EQUAL", "&k_excl", "&k_dquo", "&kp SQT",  "&kp GRAVE", "&trans"],
-        ["",       "",          "",         "",        "&none",   "&none",     "&none", "&none", "&pc_dlwd",  "&pc_dlwf", "",        "",         "",          ""],
-    ]),
-    ("brackets_mac_layer", "BRACKETS MAC", [
-        ["",       "&kp LBKT",  "&kp RBKT", "&k_lt",   "&k_gt",   "&k_coln",   "",      "",      "&k_coln",   "&k_lt",   "&k_gt",   "&kp LBKT", "&kp RBKT",  ""],
-        ["",       "&k_lcrl",   "&k_rcrl",  "&k_lprn", "&k_rprn", "&kp SEMI",  "",      "",      "&kp SEMI",  "&k_lprn", "&k_rprn", "&k_lcrl",  "&k_rcrl",   ""],
-        ["&trans", "&kp GRAVE", "&kp SQT",  "&k_dquo", "&k_excl", "&kp EQUAL", "",      "",      "&kp EQUAL", "&k_excl", "&k_dquo", "&kp SQT",  "&kp GRAVE", "&trans"],
-        ["",       "",          "",         "",        "&none",   "&none",     "&none", "&none", "&mc_dlwd",  "&mc_dlwf", "",        "",         "",          ""],
-    ]),
-    ("numbers_layer", "NUMBERS", [
+    brackets_pc,
+    brackets_pc.derive("brackets_mac_layer", "BRACKETS MAC", PC_TO_MAC),
+    Layer("numbers_layer", "NUMBERS", [
         ["",       "&k_star",  "&kp N7", "&kp N8", "&kp N9",    "&k_plus",   "",        "",      "&k_plus",   "&kp N7",    "&kp N8", "&kp N9", "&k_star",  ""],
         ["",       "&kp FSLH", "&kp N4", "&kp N5", "&kp N6",    "&kp MINUS", "",        "",      "&kp MINUS", "&kp N4",    "&kp N5", "&kp N6", "&kp FSLH", ""],
         ["&trans", "&kp N0",   "&kp N1", "&kp N2", "&kp N3",    "&kp EQUAL", "",        "",      "&kp EQUAL", "&kp N1",    "&kp N2", "&kp N3", "&kp N0",   "&trans"],
         ["",       "",         "",       "",       "&kp COMMA", "&kp DOT",   "&kp RET", "&none", "&kp DOT",   "&kp COMMA", "",       "",       "",         ""],
     ]),
-    ("navigation_pc_layer", "NAVIGATION PC", [
-        ["",       "&pc_undo", "&pc_cut",   "&pc_copy",  "&pc_pste", "&pc_redo", "",      "",      "&pc_gobk", "&pc_wdlf", "&pc_gtbr", "&pc_gtbr", "&pc_wdrt",  ""],
-        ["",       "&kp HOME", "&kp PG_DN", "&kp PG_UP", "&kp END",  "&pc_prnt", "",      "",      "&pc_prnt", "&kp LEFT", "&kp DOWN", "&kp UP",   "&kp RIGHT", ""],
-        ["&trans", "&pc_gtln", "&pc_zmbk",  "&pc_zmfw",  "&pc_swfl", "&pc_palt", "",      "",      "&pc_palt", "&pc_swfl", "&pc_zmfw", "&pc_zmbk", "&pc_gtln",  "&trans"],
-        ["",       "",         "",          "",          "&pc_slal", "&pc_save", "&none", "&none", "&pc_dlls", "&pc_dlle", "",         "",         "",          ""],
-    ]),
-    ("navigation_mac_layer", "NAVIGATION MAC", [
-        ["",       "&mc_undo", "&mc_cut",   "&mc_copy",  "&mc_pste", "&mc_redo", "",      "",      "&mc_gobk", "&mc_wdlf", "&mc_gtbr", "&mc_gtbr", "&mc_wdrt",  ""],
-        ["",       "&kp HOME", "&kp PG_DN", "&kp PG_UP", "&kp END",  "&mc_prnt", "",      "",      "&mc_prnt", "&kp LEFT", "&kp DOWN", "&kp UP",   "&kp RIGHT", ""],
-        ["&trans", "&mc_gtln", "&mc_zmbk",  "&mc_zmfw",  "&mc_swfl", "&mc_palt", "",      "",      "&mc_palt", "&mc_swfl", "&mc_zmfw", "&mc_zmbk", "&mc_gtln",  "&trans"],
-        ["",       "",         "",          "",          "&mc_slal", "&mc_save", "&none", "&none", "&mc_dlls", "&mc_dlle", "",         "",         "",          ""],
-    ]),
-    ("shortcuts_pc_layer", "SHORTCUTS PC", [
-        ["",       "&pc_scrn", "&pc_cmnt", "&pc_rpfl", "&pc_fnfl", "&pc_zmin", "",       "",       "&pc_zmin", "&pc_fnfl", "&pc_rpfl", "&pc_cmnt", "&pc_scrn", ""],
-        ["",       "&pc_shot", "&pc_frmt", "&pc_rplc", "&pc_find", "&pc_zmot", "",       "",       "&pc_zmot", "&pc_find", "&pc_rplc", "&pc_frmt", "&pc_shot", ""],
-        ["&trans", "&pc_srec", "&pc_gdef", "&pc_gimp", "&pc_qfix", "&pc_ctab", "",       "",       "&pc_ctab", "&pc_qfix", "&pc_gimp", "&pc_gdef", "&pc_srec", "&trans"],
-        ["",       "",         "",         "",         "&trans",   "&trans",   "&trans", "&trans", "&trans",   "&trans",   "",         "",         "",         ""],
-    ]),
-    ("shortcuts_mac_layer", "SHORTCUTS MAC", [
-        ["",       "&mc_scrn", "&mc_cmnt", "&mc_rpfl", "&mc_fnfl", "&mc_zmin", "",       "",       "&mc_zmin", "&mc_fnfl", "&mc_rpfl", "&mc_cmnt", "&mc_scrn", ""],
-        ["",       "&mc_shot", "&mc_frmt", "&mc_rplc", "&mc_find", "&mc_zmot", "",       "",       "&mc_zmot", "&mc_find", "&mc_rplc", "&mc_frmt", "&mc_shot", ""],
-        ["&trans", "&mc_srec", "&mc_gdef", "&mc_gimp", "&mc_qfix", "&mc_ctab", "",       "",       "&mc_ctab", "&mc_qfix", "&mc_gimp", "&mc_gdef", "&mc_srec", "&trans"],
-        ["",       "",         "",         "",         "&trans",   "&trans",   "&trans", "&trans", "&trans",   "&trans",   "",         "",         "",         ""],
-    ]),
-    ("function_layer", "FUNCTION", [
+    navigation_pc,
+    navigation_pc.derive("navigation_mac_layer", "NAVIGATION MAC", PC_TO_MAC),
+    shortcuts_pc,
+    shortcuts_pc.derive("shortcuts_mac_layer", "SHORTCUTS MAC", PC_TO_MAC),
+    Layer("function_layer", "FUNCTION", [
         ["",       "to_pc",   "&kp F9", "&kp F8", "&kp F7", "&kp F10", "",      "",      "&kp F10", "&kp F7", "&kp F8", "&kp F9", "to_pc",   ""],
         ["",       "to_mac",  "&kp F6", "&kp F5", "&kp F4", "&kp F11", "",      "",      "&kp F11", "&kp F4", "&kp F5", "&kp F6", "to_mac",  ""],
         ["&trans", "to_game", "&kp F3", "&kp F2", "&kp F1", "&kp F12", "",      "",      "&kp F12", "&kp F1", "&kp F2", "&kp F3", "to_game", "&trans"],
         ["",       "",        "",       "",       "&none",  "&none",   "&none", "&none", "&none",   "&none",  "",       "",       "",        ""],
     ]),
-    ("bluetooth_layer", "BLUETOOTH", [
+    Layer("bluetooth_layer", "BLUETOOTH", [
         ["",       "&bt0_pc",    "&bt1_mac",     "&bt2",       "&bt3",        "&bt4",   "",       "",       "&trans", "&trans", "&trans", "&trans", "to_pc",   ""],
         ["",       "&trans",     "&trans",       "&trans",     "&trans",      "&trans", "",       "",       "&trans", "&trans", "&trans", "&trans", "to_mac",  ""],
         ["&trans", "&bt BT_CLR", "&out OUT_TOG", "&sys_reset", "&bootloader", "&trans", "",       "",       "&trans", "&trans", "&trans", "&trans", "to_game", "&trans"],
@@ -170,158 +1226,270 @@ header = """#include <behaviors.dtsi>
   tapping-term-ms = <170>;
 };
 
-/ {
-        macros {
-                // BT profile macros
-                bt0_pc: bt0_pc {
-                        compatible = "zmk,behavior-macro";
-                        #binding-cells = <0>;
-                        bindings = <&bt BT_SEL 0>, <&to COLEMAK_PC>;
-                };
-                bt1_mac: bt1_mac {
-                        compatible = "zmk,behavior-macro";
-                        #binding-cells = <0>;
-                        bindings = <&bt BT_SEL 1>, <&to COLEMAK_MAC>;
-                };
-                bt2: bt2 { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&bt BT_SEL 2>; };
-                bt3: bt3 { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&bt BT_SEL 3>; };
-                bt4: bt4 { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&bt BT_SEL 4>; };
-
-                // PC Shortcuts
-                pc_scrn: pc_scrn { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp PSCRN>; };
-                pc_cmnt: pc_cmnt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(FSLH)>; };
-                pc_rpfl: pc_rpfl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LS(H))>; };
-                pc_fnfl: pc_fnfl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LS(F))>; };
-                pc_zmin: pc_zmin { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LS(EQUAL))>; };
-                pc_zmot: pc_zmot { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(MINUS)>; };
-                pc_shot: pc_shot { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(S))>; };
-                pc_frmt: pc_frmt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(LA(F))>; };
-                pc_rplc: pc_rplc { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(H)>; };
-                pc_find: pc_find { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(F)>; };
-                pc_srec: pc_srec { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LA(R))>; };
-                pc_gdef: pc_gdef { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp F12>; };
-                pc_gimp: pc_gimp { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(F12)>; };
-                pc_qfix: pc_qfix { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(DOT)>; };
-                pc_ctab: pc_ctab { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(W)>; };
-                pc_capp: pc_capp { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LA(F4)>; };
-
-                // Mac Shortcuts
-                mc_scrn: mc_scrn { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(N3))>; };
-                mc_cmnt: mc_cmnt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(FSLH)>; };
-                mc_rpfl: mc_rpfl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(H))>; };
-                mc_fnfl: mc_fnfl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(F))>; };
-                mc_zmin: mc_zmin { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(EQUAL))>; };
-                mc_zmot: mc_zmot { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(MINUS)>; };
-                mc_shot: mc_shot { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(N4))>; };
-                mc_frmt: mc_frmt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(LA(F))>; };
-                mc_rplc: mc_rplc { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LA(F))>; };
-                mc_find: mc_find { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(F)>; };
-                mc_srec: mc_srec { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(N5))>; };
-                mc_gdef: mc_gdef { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp F12>; };
-                mc_gimp: mc_gimp { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(F12)>; };
-                mc_qfix: mc_qfix { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(DOT)>; };
-                mc_ctab: mc_ctab { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(W)>; };
-                mc_capp: mc_capp { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(Q)>; };
-
-                // Shifted number symbols: ! @ # $ % ^ & * ( )
-                k_excl: k_excl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N1)>; };
-                k_at:   k_at   { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N2)>; };
-                k_hash: k_hash { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N3)>; };
-                k_dllr: k_dllr { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N4)>; };
-                k_pcnt: k_pcnt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N5)>; };
-                k_cart: k_cart { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N6)>; };
-                k_ampr: k_ampr { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N7)>; };
-                k_star: k_star { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N8)>; };
-                k_lprn: k_lprn { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N9)>; };
-                k_rprn: k_rprn { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(N0)>; };
-
-                // Shifted punctuation
-                k_pipe: k_pipe { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(BSLH)>; };
-                k_plus: k_plus { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(EQUAL)>; };
-                k_undr: k_undr { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(MINUS)>; };
-                k_tild: k_tild { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(GRAVE)>; };
-                k_lcrl: k_lcrl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(LBKT)>; };
-                k_rcrl: k_rcrl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(RBKT)>; };
-                k_lt:   k_lt   { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(COMMA)>; };
-                k_gt:   k_gt   { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(DOT)>; };
-                k_coln: k_coln { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(SEMI)>; };
-                k_dquo: k_dquo { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(SQT)>; };
-                k_ques: k_ques { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(FSLH)>; };
-
-                // PC Navigation combos
-                pc_undo: pc_undo { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(Z)>; };
-                pc_redo: pc_redo { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LS(Z))>; };
-                pc_cut:  pc_cut  { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(X)>; };
-                pc_copy: pc_copy { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(C)>; };
-                pc_pste: pc_pste { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(V)>; };
-                pc_slal: pc_slal { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(A)>; };
-                pc_save: pc_save { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(S)>; };
-                pc_gtln: pc_gtln { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(G)>; };
-                pc_zmbk: pc_zmbk { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(MINUS)>; };
-                pc_zmfw: pc_zmfw { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(EQUAL)>; };
-                pc_swfl: pc_swfl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LS(O))>; };
-                pc_prnt: pc_prnt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(P)>; };
-                pc_palt: pc_palt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LS(P))>; };
-
-                // Mac Navigation combos
-                mc_undo: mc_undo { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(Z)>; };
-                mc_redo: mc_redo { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(Z))>; };
-                mc_cut:  mc_cut  { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(X)>; };
-                mc_copy: mc_copy { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(C)>; };
-                mc_pste: mc_pste { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(V)>; };
-                mc_slal: mc_slal { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(A)>; };
-                mc_save: mc_save { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(S)>; };
-                mc_gtln: mc_gtln { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(G)>; };
-                mc_zmbk: mc_zmbk { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(MINUS)>; };
-                mc_zmfw: mc_zmfw { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(EQUAL)>; };
-                mc_swfl: mc_swfl { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(O))>; };
-                mc_prnt: mc_prnt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(P)>; };
-                mc_palt: mc_palt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(P))>; };
-
-                // Delete word macros
-                pc_dlwd: pc_dlwd { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(BSPC)>; };
-                pc_dlwf: pc_dlwf { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(DEL)>; };
-                mc_dlwd: mc_dlwd { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LA(BSPC)>; };
-                mc_dlwf: mc_dlwf { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LA(DEL)>; };
-
-                // Delete to line start/end macros
-                pc_dlls: pc_dlls { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(HOME)>, <&kp BSPC>; };
-                pc_dlle: pc_dlle { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LS(END)>, <&kp DEL>; };
-                mc_dlls: mc_dlls { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(BSPC)>; };
-                mc_dlle: mc_dlle { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(K)>; };
-
-                // Word movement macros
-                pc_wdlf: pc_wdlf { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LEFT)>; };
-                pc_wdrt: pc_wdrt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(RIGHT)>; };
-                mc_wdlf: mc_wdlf { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LA(LEFT)>; };
-                mc_wdrt: mc_wdrt { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LA(RIGHT)>; };
-
-                // Go to matching bracket macros
-                pc_gtbr: pc_gtbr { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(LS(BSLH))>; };
-                mc_gtbr: mc_gtbr { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LG(LS(BSLH))>; };
-
-                // Go back (previous cursor position) macros
-                pc_gobk: pc_gobk { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LA(LEFT)>; };
-                mc_gobk: mc_gobk { compatible = "zmk,behavior-macro"; #binding-cells = <0>; bindings = <&kp LC(MINUS)>; };
-        };
-
-        keymap {
-                compatible = "zmk,keymap";
 """
 
+# Macros as (comment, [(name, [bindings])]); each becomes a zmk,behavior-macro node
+macros = [
+    ("BT profile macros", [
+        ("bt0_pc",  ["&bt BT_SEL 0", "&to COLEMAK_PC"]),
+        ("bt1_mac", ["&bt BT_SEL 1", "&to COLEMAK_MAC"]),
+        ("bt2",     ["&bt BT_SEL 2"]),
+        ("bt3",     ["&bt BT_SEL 3"]),
+        ("bt4",     ["&bt BT_SEL 4"]),
+    ]),
+    ("PC Shortcuts", [
+        ("pc_scrn", ["&kp PSCRN"]),
+        ("pc_cmnt", ["&kp LC(FSLH)"]),
+        ("pc_rpfl", ["&kp LC(LS(H))"]),
+        ("pc_fnfl", ["&kp LC(LS(F))"]),
+        ("pc_zmin", ["&kp LC(LS(EQUAL))"]),
+        ("pc_zmot", ["&kp LC(MINUS)"]),
+        ("pc_shot", ["&kp LG(LS(S))"]),
+        ("pc_frmt", ["&kp LS(LA(F))"]),
+        ("pc_rplc", ["&kp LC(H)"]),
+        ("pc_find", ["&kp LC(F)"]),
+        ("pc_srec", ["&kp LG(LA(R))"]),
+        ("pc_gdef", ["&kp F12"]),
+        ("pc_gimp", ["&kp LC(F12)"]),
+        ("pc_qfix", ["&kp LC(DOT)"]),
+        ("pc_ctab", ["&kp LC(W)"]),
+        ("pc_capp", ["&kp LA(F4)"]),
+    ]),
+    ("Mac Shortcuts", [
+        ("mc_scrn", ["&kp LG(LS(N3))"]),
+        ("mc_cmnt", ["&kp LG(FSLH)"]),
+        ("mc_rpfl", ["&kp LG(LS(H))"]),
+        ("mc_fnfl", ["&kp LG(LS(F))"]),
+        ("mc_zmin", ["&kp LG(LS(EQUAL))"]),
+        ("mc_zmot", ["&kp LG(MINUS)"]),
+        ("mc_shot", ["&kp LG(LS(N4))"]),
+        ("mc_frmt", ["&kp LS(LA(F))"]),
+        ("mc_rplc", ["&kp LG(LA(F))"]),
+        ("mc_find", ["&kp LG(F)"]),
+        ("mc_srec", ["&kp LG(LS(N5))"]),
+        ("mc_gdef", ["&kp F12"]),
+        ("mc_gimp", ["&kp LG(F12)"]),
+        ("mc_qfix", ["&kp LG(DOT)"]),
+        ("mc_ctab", ["&kp LG(W)"]),
+        ("mc_capp", ["&kp LG(Q)"]),
+    ]),
+    ("Shifted number symbols: ! @ # $ % ^ & * ( )", [
+        ("k_excl", ["&kp LS(N1)"]),
+        ("k_at",   ["&kp LS(N2)"]),
+        ("k_hash", ["&kp LS(N3)"]),
+        ("k_dllr", ["&kp LS(N4)"]),
+        ("k_pcnt", ["&kp LS(N5)"]),
+        ("k_cart", ["&kp LS(N6)"]),
+        ("k_ampr", ["&kp LS(N7)"]),
+        ("k_star", ["&kp LS(N8)"]),
+        ("k_lprn", ["&kp LS(N9)"]),
+        ("k_rprn", ["&kp LS(N0)"]),
+    ]),
+    ("Shifted punctuation", [
+        ("k_pipe", ["&kp LS(BSLH)"]),
+        ("k_plus", ["&kp LS(EQUAL)"]),
+        ("k_undr", ["&kp LS(MINUS)"]),
+        ("k_tild", ["&kp LS(GRAVE)"]),
+        ("k_lcrl", ["&kp LS(LBKT)"]),
+        ("k_rcrl", ["&kp LS(RBKT)"]),
+        ("k_lt",   ["&kp LS(COMMA)"]),
+        ("k_gt",   ["&kp LS(DOT)"]),
+        ("k_coln", ["&kp LS(SEMI)"]),
+        ("k_dquo", ["&kp LS(SQT)"]),
+        ("k_ques", ["&kp LS(FSLH)"]),
+    ]),
+    ("PC Navigation combos", [
+        ("pc_undo", ["&kp LC(Z)"]),
+        ("pc_redo", ["&kp LC(LS(Z))"]),
+        ("pc_cut",  ["&kp LC(X)"]),
+        ("pc_copy", ["&kp LC(C)"]),
+        ("pc_pste", ["&kp LC(V)"]),
+        ("pc_slal", ["&kp LC(A)"]),
+        ("pc_save", ["&kp LC(S)"]),
+        ("pc_gtln", ["&kp LC(G)"]),
+        ("pc_zmbk", ["&kp LC(MINUS)"]),
+        ("pc_zmfw", ["&kp LC(EQUAL)"]),
+        ("pc_swfl", ["&kp LC(LS(O))"]),
+        ("pc_prnt", ["&kp LC(P)"]),
+        ("pc_palt", ["&kp LC(LS(P))"]),
+    ]),
+    ("Mac Navigation combos", [
+        ("mc_undo", ["&kp LG(Z)"]),
+        ("mc_redo", ["&kp LG(LS(Z))"]),
+        ("mc_cut",  ["&kp LG(X)"]),
+        ("mc_copy", ["&kp LG(C)"]),
+        ("mc_pste", ["&kp LG(V)"]),
+        ("mc_slal", ["&kp LG(A)"]),
+        ("mc_save", ["&kp LG(S)"]),
+        ("mc_gtln", ["&kp LC(G)"]),
+        ("mc_zmbk", ["&kp LG(MINUS)"]),
+        ("mc_zmfw", ["&kp LG(EQUAL)"]),
+        ("mc_swfl", ["&kp LG(LS(O))"]),
+        ("mc_prnt", ["&kp LG(P)"]),
+        ("mc_palt", ["&kp LG(LS(P))"]),
+    ]),
+    ("Delete word macros", [
+        ("pc_dlwd", ["&kp LC(BSPC)"]),
+        ("pc_dlwf", ["&kp LC(DEL)"]),
+        ("mc_dlwd", ["&kp LA(BSPC)"]),
+        ("mc_dlwf", ["&kp LA(DEL)"]),
+    ]),
+    ("Delete to line start/end macros", [
+        ("pc_dlls", ["&kp LS(HOME)", "&kp BSPC"]),
+        ("pc_dlle", ["&kp LS(END)", "&kp DEL"]),
+        ("mc_dlls", ["&kp LG(BSPC)"]),
+        ("mc_dlle", ["&kp LC(K)"]),
+    ]),
+    ("Word movement macros", [
+        ("pc_wdlf", ["&kp LC(LEFT)"]),
+        ("pc_wdrt", ["&kp LC(RIGHT)"]),
+        ("mc_wdlf", ["&kp LA(LEFT)"]),
+        ("mc_wdrt", ["&kp LA(RIGHT)"]),
+    ]),
+    ("Go to matching bracket macros", [
+        ("pc_gtbr", ["&kp LC(LS(BSLH))"]),
+        ("mc_gtbr", ["&kp LG(LS(BSLH))"]),
+    ]),
+    ("Go back (previous cursor position) macros", [
+        ("pc_gobk", ["&kp LA(LEFT)"]),
+        ("mc_gobk", ["&kp LC(MINUS)"]),
+    ]),
+]
+
+
+# Combos as (name, [(row, col) grid cells], binding, layer names or None for all, timeout ms)
+combos = [
+    ("combo_esc",  [(0, 2), (0, 3)],   "&kp ESC",    ["colemak_pc_layer", "colemak_mac_layer"], 30),
+    ("combo_lprn", [(2, 2), (2, 3)],   "&kp LS(N9)", ["colemak_pc_layer", "colemak_mac_layer"], 30),
+    ("combo_rprn", [(2, 10), (2, 11)], "&kp LS(N0)", ["colemak_pc_layer", "colemak_mac_layer"], 30),
+]
+
 footer = """        };
 };
 """
 
+KEYMAP_PATH = "config/totem.keymap"
+CACHE_PATH = ".keymap_cache.json"
+SHIELD_PATH = "config/boards/shields/totem/totem.dtsi"
+JSON_PATH = "docs/keymap.json"
+SVG_PATH = "docs/images/TOTEM_layers.svg"
+
 if __name__ == "__main__":
-    output = header
-    for name, label, grid in layers:
-        output += "\n" + format_layer(name, label, grid) + "\n"
-    output += footer
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--no-inline", action="store_true",
+                        help="keep single-binding macros as macro nodes")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="re-render every section and leave the cache untouched")
+    parser.add_argument("--no-prune", action="store_true",
+                        help="keep unreachable layers and unreferenced macros")
+    parser.add_argument("--max-nodes", type=int, help="fail when the keymap needs more devicetree nodes")
+    parser.add_argument("--max-bytes", type=int, help="fail when the estimated binding/macro bytes exceed this")
+    parser.add_argument("--combos-per-key", type=int, default=COMBOS_PER_KEY,
+                        help="combos allowed per key (raise CONFIG_ZMK_COMBO_MAX_COMBOS_PER_KEY to match)")
+    parser.add_argument("--json", default=JSON_PATH, metavar="PATH",
+                        help=f"where layers and resolved bindings are exported as JSON (default {JSON_PATH})")
+    parser.add_argument("--no-json", action="store_true", help="skip the JSON export")
+    parser.add_argument("--svg", default=SVG_PATH, metavar="PATH",
+                        help=f"where every layer is drawn in the TOTEM shape as SVG (default {SVG_PATH})")
+    parser.add_argument("--no-svg", action="store_true", help="skip the SVG diagram")
+    parser.add_argument("--shield", metavar="DTSI",
+                        help=f"shield whose matrix transform lays out the grids (default {SHIELD_PATH})")
+    parser.add_argument("--watch", action="store_true",
+                        help="regenerate the keymap whenever this file is saved")
+    parser.add_argument("--profile", nargs="?", const="format_keymap", metavar="PREFIX",
+                        help="dump cProfile stats to PREFIX.prof and a tracemalloc snapshot to PREFIX.mem")
+    commands = parser.add_subparsers(dest="command")
+    opt = commands.add_parser("optimize", help="search symbol layer placements against a corpus")
+    opt.add_argument("corpus", nargs="+", help="text files, or keylogs with --keylog")
+    opt.add_argument("--keylog", action="store_true",
+                     help="corpus files hold one binding per line (e.g. &pc_copy)")
+    opt.add_argument("--layers", default="symbols_layer,brackets_pc_layer,numbers_layer",
+                     help="comma separated layer names to rearrange")
+    opt.add_argument("--base", default=layers[0][0], help="layer whose thumbs hold the others")
+    opt.add_argument("--jobs", type=int, default=0, help="worker processes (default: all CPUs)")
+    opt.add_argument("--chains", type=int, default=256, help="annealing chains per worker")
+    opt.add_argument("--steps", type=int, default=20000, help="annealing steps per chain")
+    opt.add_argument("--seed", type=int, default=0)
+    batch = commands.add_parser("batch", help="render a keymap per variant spec in a directory")
+    batch.add_argument("spec_dir", help="directory of *.json variant specs")
+    batch.add_argument("--out-dir", default="build/keymaps", help="where variant keymaps are written")
+    batch.add_argument("--jobs", type=int, default=None, help="worker processes (default: all CPUs)")
+    batch.add_argument("--export", action="append", choices=("json", "svg"), default=[],
+                       help="also write this export next to each keymap (repeatable)")
+    check = commands.add_parser("check", help="verify keymaps in the generator's layout re-emit byte-identically")
+    check.add_argument("keymaps", nargs="*", default=[KEYMAP_PATH])
+    imp = commands.add_parser("import", help="print a keymap as `macros` and `layers` tables")
+    imp.add_argument("keymap")
+    args = parser.parse_args()
+    if args.profile:
+        start_profiling(args.profile)
+
+    if args.command == "check":
+        failed = 0
+        for path in args.keymaps:
+            try:
+                section = check_keymap(path, load_geometry(args.shield or SHIELD_PATH))
+            except (OSError, ValueError) as e:
+                print(f"{path}: {e}")
+                failed += 1
+                continue
+            if section:
+                print(f"{path}: {section} does not round-trip")
+                failed += 1
+        raise SystemExit(1 if failed else 0)
+
+    if args.command == "import":
+        names = {}
+        try:
+            geometry = load_geometry(args.shield or SHIELD_PATH)
+            with open(args.keymap) as f:
+                for kind, _, value in iter_keymap(f, geometry):
+                    if kind == "macros":
+                        print(format_macros_source(value[0]))
+                        print("\nlayers = [")
+                    elif kind == "layer":
+                        names[layer_const(value[1])] = value[0]
+                        print(format_layer_source(*value))
+                    elif kind == "footer":
+                        print("]\n\ncombos = [")
+                        for name, positions, binding, combo_layers, timeout in value:
+                            if combo_layers is not None:
+                                combo_layers = [names.get(const, const) for const in combo_layers]
+                            print(f"    ({name!r}, {[geometry.cells[p] for p in positions]}, {binding!r}, "
+                                  f"{combo_layers!r}, {timeout}),".replace("'", '"'))
+        except (OSError, ValueError) as e:
+            sys.exit(f"{args.keymap}: {e}")
+        print("]")
+        raise SystemExit(0)
+
+    if args.command == "batch":
+        raise SystemExit(1 if run_batch(args.spec_dir, args.out_dir, not args.no_inline, not args.no_prune,
+                                     (args.max_nodes, args.max_bytes), args.combos_per_key,
+                                     args.jobs, args.export, args.shield) else 0)
+
+    if args.watch:
+        watch(os.path.abspath(__file__), args)
+        raise SystemExit(0)
+
+    if args.command == "optimize":
+        from layout_optimizer import optimize
+        single = {name: b[0] for _, entries in macros for name, b in entries if len(b) == 1}
+        optimize(layers, parse_defines(header), single, args,
+                 load_geometry(args.shield or SHIELD_PATH))
+        raise SystemExit(0)
 
-    with open("config/totem.keymap", "w") as f:
-        f.write(output)
+    cache = None if args.no_cache else load_cache(CACHE_PATH)
+    paths = output_paths(args)
+    try:
+        written, changed, report, out_layers = build(globals(), args, cache, paths)
+    except ValueError as e:
+        sys.exit(str(e))
+    print("\n".join(report))
+    for path in filter(None, paths.values()):
+        print(f"Generated {path}" if path in written else f"{path} unchanged, not rewritten")
+    if cache is not None:
+        print("Changed sections: " + (", ".join(changed) if changed else "none"))
+        save_cache(CACHE_PATH, cache)
 
-    print("Generated config/totem.keymap")
     print("\nPreview of first layer:")
-    print(format_layer(layers[0][0], layers[0][1], layers[0][2]))
+    print(format_layer(*out_layers[0], load_geometry(args.shield or SHIELD_PATH)))
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+"""Replay timestamped keylogs against the hold-tap bindings in format_keymap.
+
+Keylogs are CSV files (or .npy arrays) with one event per line:
+
+    time_ms,position,pressed[,intent]
+
+`position` is the ZMK key position (0-37 on the TOTEM), `pressed` is 1 for a
+key press and 0 for a release. The optional `intent` column marks what a
+hold-tap press was meant to be (1 hold, 0 tap, -1 unknown); when it is absent
+a press is taken as an intended hold if another key was pressed and released
+while it was held.
+
+Resolution follows ZMK's hold-tap flavors. One parameter set is applied to
+every hold-tap in the layer; note that the `&mt { ... }` node in the header
+only configures `&mt`, so `&lt` needs a matching node to get the same timing.
+"""
+
+import argparse
+import sys
+
+import numpy as np
+
+from format_keymap import header, layers, parse_defines, shield_geometry
+
+FLAVORS = ("tap-preferred", "hold-preferred", "balanced")
+LOOKAHEAD = 8  # keystrokes scanned after a hold-tap press for interrupting keys
+
+
+def parse_holdtap_config(text, behavior="mt"):
+    """Return the hold-tap settings of the `&behavior { ... };` node in text."""
+    config = {"tapping-term-ms": 200, "quick-tap-ms": 0,
+              "flavor": "hold-preferred", "global-quick-tap": False}
+    start = text.find(f"&{behavior} {{")
+    if start < 0:
+        return config
+    body = text[text.index("{", start) + 1:text.index("};", start)]
+    for stmt in body.split(";"):
+        stmt = stmt.strip()
+        if not stmt:
+            continue
+        if "=" not in stmt:
+            config[stmt] = True
+            continue
+        key, value = (s.strip() for s in stmt.split("=", 1))
+        config[key] = value.strip('"') if value.startswith('"') else int(value.strip("<>"))
+    return config
+
+
+def holdtap_positions(grid, defines, geometry):
+    """Return the key positions whose binding resolves to `&mt` or `&lt`."""
+    positions = []
+    for pos, (r, c) in enumerate(geometry.cells):
+        binding = defines.get(grid[r][c], grid[r][c])
+        if binding.split()[0] in ("&mt", "&lt"):
+            positions.append(pos)
+    return positions
+
+
+def load_keylog(path):
+    """Load a keylog as an (N, 4) int64 array of time, position, pressed, intent."""
+    if path.endswith(".npy"):
+        events = np.load(path, mmap_mode="r")
+    else:
+        events = np.loadtxt(path, delimiter=",", dtype=np.int64, comments="#", ndmin=2)
+    events = np.asarray(events, dtype=np.int64)
+    if events.shape[1] == 3:
+        events = np.column_stack([events, np.full(len(events), -1, dtype=np.int64)])
+    return events[np.argsort(events[:, 0], kind="stable")]
+
+
+def pair_keystrokes(events):
+    """Pair presses with releases per position.
+
+    Returns (position, down, up, intent) arrays ordered by press time.
+    Unmatched trailing presses are dropped.
+    """
+    order = np.lexsort((events[:, 0], events[:, 1]))
+    ev = events[order]
+    down = ev[:-1, 2] == 1
+    matched = down & (ev[1:, 2] == 0) & (ev[1:, 1] == ev[:-1, 1])
+    idx = np.flatnonzero(matched)
+    pos, t_down, intent = ev[idx, 1], ev[idx, 0], ev[idx, 3]
+    t_up = ev[idx + 1, 0]
+    by_time = np.argsort(t_down, kind="stable")
+    return pos[by_time], t_down[by_time], t_up[by_time], intent[by_time]
+
+
+class Keystrokes:
+    """Precomputed keystroke arrays shared by every candidate in a sweep."""
+
+    def __init__(self, events, ht_positions):
+        self.pos, self.down, self.up, intent = pair_keystrokes(events)
+        n = len(self.pos)
+        self.is_ht = np.isin(self.pos, ht_positions)
+        inf = np.iinfo(np.int64).max
+
+        # First press after each keystroke and earliest release of a key that
+        # was pressed and released inside its hold (the balanced trigger).
+        self.next_down = np.full(n, inf, dtype=np.int64)
+        self.next_down[:-1] = self.down[1:]
+        self.inner_up = np.full(n, inf, dtype=np.int64)
+        for k in range(1, LOOKAHEAD + 1):
+            j_down = self.down[k:]
+            j_up = self.up[k:]
+            held = (j_down < self.up[:-k]) & (j_up < self.up[:-k])
+            cand = np.where(held, j_up, inf)
+            np.minimum(self.inner_up[:-k], cand, out=self.inner_up[:-k])
+
+        guessed = (self.inner_up != inf).astype(np.int64)
+        self.intent_hold = np.where(intent >= 0, intent, guessed).astype(bool)
+
+        # Previous keystroke at the same position, for non-global quick-tap.
+        order = np.lexsort((self.down, self.pos))
+        same = np.r_[False, self.pos[order][1:] == self.pos[order][:-1]]
+        self.prev_same = np.full(n, -1, dtype=np.int64)
+        self.prev_same[order[same]] = order[np.flatnonzero(same) - 1]
+
+
+def resolve(ks, tapping_term, quick_tap, flavor, global_quick_tap):
+    """Resolve every hold-tap press for one parameter set.
+
+    Returns (hold, resolved_at): whether each keystroke became a hold and the
+    time its output was decided. Plain keys resolve at their press time.
+    """
+    timeout = ks.down + tapping_term
+    if flavor == "tap-preferred":
+        trigger = timeout
+    elif flavor == "hold-preferred":
+        trigger = np.minimum(timeout, ks.next_down)
+    elif flavor == "balanced":
+        trigger = np.minimum(timeout, ks.inner_up)
+    else:
+        raise ValueError(f"Unknown flavor: {flavor}")
+    hold = ks.is_ht & (trigger < ks.up)
+    resolved_at = np.where(ks.is_ht, np.where(hold, trigger, ks.up), ks.down)
+
+    if quick_tap:
+        # Quick-tap only counts prior taps, so iterate until no more holds
+        # flip back to taps (flips are one-way, so this terminates).
+        if global_quick_tap:
+            prev = np.arange(len(ks.down)) - 1
+        else:
+            prev = ks.prev_same
+        has_prev = prev >= 0
+        prev_down = np.where(has_prev, ks.down[prev], 0)
+        recent = ks.is_ht & has_prev & (ks.down - prev_down < quick_tap)
+        while True:
+            quick = recent & ~hold[prev]
+            flipped = quick & (hold | (resolved_at != ks.down))
+            if not flipped.any():
+                break
+            hold = hold & ~quick
+            resolved_at = np.where(quick, ks.down, resolved_at)
+    return hold, resolved_at
+
+
+def evaluate(ks, tapping_term, quick_tap, flavor, global_quick_tap):
+    """Return added delay per keystroke and misfire counts for one parameter set."""
+    hold, resolved_at = resolve(ks, tapping_term, quick_tap, flavor, global_quick_tap)
+    # Keys pressed while an earlier hold-tap is undecided wait for its decision.
+    pending = np.maximum.accumulate(resolved_at)
+    pending = np.r_[np.iinfo(np.int64).min, pending[:-1]]
+    delay = np.maximum(resolved_at, pending) - ks.down
+    tap_as_hold = int(np.count_nonzero(ks.is_ht & hold & ~ks.intent_hold))
+    hold_as_tap = int(np.count_nonzero(ks.is_ht & ~hold & ks.intent_hold))
+    return delay, tap_as_hold, hold_as_tap
+
+
+def parse_range(spec):
+    """Parse `a,b,c` or `start:stop:step` into a list of ints."""
+    if ":" in spec:
+        start, stop, step = (int(s) for s in spec.split(":"))
+        return list(range(start, stop + 1, step))
+    return [int(s) for s in spec.split(",")]
+
+
+if __name__ == "__main__":
+    mt = parse_holdtap_config(header, "mt")
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("keylogs", nargs="+", help="CSV or .npy keylog files")
+    parser.add_argument("--layer", default=layers[0][0], help="layer whose bindings are replayed")
+    parser.add_argument("--tapping-term", default=str(mt["tapping-term-ms"]),
+                        help="values as a,b,c or start:stop:step (ms)")
+    parser.add_argument("--quick-tap", default=str(mt["quick-tap-ms"]),
+                        help="values as a,b,c or start:stop:step (ms)")
+    parser.add_argument("--flavor", default=mt["flavor"],
+                        help=f"comma separated, from {', '.join(FLAVORS)}")
+    parser.add_argument("--per-key", action="store_true",
+                        help="print mean added delay per key position for the best candidate")
+    args = parser.parse_args()
+
+    grid = next((g for name, _, g in layers if name == args.layer), None)
+    if grid is None:
+        sys.exit(f"Unknown layer: {args.layer}")
+    ht_positions = holdtap_positions(grid, parse_defines(header), shield_geometry())
+
+    events = np.concatenate([load_keylog(path) for path in args.keylogs])
+    events = events[np.argsort(events[:, 0], kind="stable")]
+    ks = Keystrokes(events, ht_positions)
+    print(f"{len(ks.pos)} keystrokes, {int(ks.is_ht.sum())} on hold-tap keys {ht_positions}")
+
+    results = []
+    print(f"{'flavor':<15} {'term':>5} {'quick':>5} {'mean ms':>8} {'p99 ms':>7} "
+          f"{'tap->hold':>9} {'hold->tap':>9}")
+    for flavor in args.flavor.split(","):
+        for term in parse_range(args.tapping_term):
+            for quick in parse_range(args.quick_tap):
+                delay, tap_as_hold, hold_as_tap = evaluate(
+                    ks, term, quick, flavor, mt["global-quick-tap"])
+                results.append((tap_as_hold + hold_as_tap, delay.mean(), flavor, term, quick, delay))
+                print(f"{flavor:<15} {term:>5} {quick:>5} {delay.mean():>8.2f} "
+                      f"{np.percentile(delay, 99):>7.0f} {tap_as_hold:>9} {hold_as_tap:>9}")
+
+    misfires, mean, flavor, term, quick, delay = min(results, key=lambda r: r[:2])
+    print(f"\nBest: flavor={flavor} tapping-term-ms={term} quick-tap-ms={quick} "
+          f"({misfires} misfires, {mean:.2f} ms mean added delay)")
+    if args.per_key:
+        sums = np.bincount(ks.pos, weights=delay)
+        counts = np.bincount(ks.pos)
+        for pos in np.flatnonzero(counts):
+            print(f"  position {pos:>2}: {sums[pos] / counts[pos]:7.2f} ms over {counts[pos]} presses")
@@ -0,0 +1,160 @@
+"""Export emitters for format_keymap's single pass over the layers.
+
+Besides the keymap itself, write_outputs can feed a JSON export of every
+layer and an SVG diagram of the layers to the same pass. Each emitter gets
+start(head), then layer(layer, keys) for every layer with its keys resolved
+through the header #defines, then end(combos).
+"""
+
+import html
+import json
+
+
+class JsonEmitter:
+    """Write every layer with its bindings resolved through the #defines.
+
+    Keys are listed in key-position order with their grid cell; bindings
+    that resolve to a macro also carry the macro's steps. Each distinct
+    binding is encoded once and its JSON reused across layers.
+    """
+
+    needs_keys = True
+
+    def __init__(self, f, groups):
+        self.f = f
+        self.macros = {name: bindings for _, entries in groups for name, bindings in entries}
+        self.encoded = {}
+        self.prefixes = None
+        self.first = True
+
+    def start(self, head):
+        self.f.write(b'{"layers": [')
+
+    def encode(self, binding, resolved):
+        fields = {"binding": binding, "resolved": resolved}
+        steps = self.macros.get(resolved[1:])
+        if steps is not None:
+            fields["macro"] = steps
+        # Without its opening brace, which the per-position prefix supplies.
+        text = self.encoded[binding] = json.dumps(fields)[1:]
+        return text
+
+    def layer(self, layer, keys):
+        name, label = layer.name, layer.label
+        if self.prefixes is None:
+            self.prefixes = [f'{{"position": {pos}, "row": {r}, "col": {c}, '
+                             for pos, (r, c, _, _) in enumerate(keys)]
+        encoded = self.encoded
+        entries = ", ".join([prefix + (encoded.get(binding) or self.encode(binding, resolved))
+                             for prefix, (_, _, binding, resolved) in zip(self.prefixes, keys)])
+        self.f.write(b"\n " if self.first else b",\n ")
+        self.f.write(f'{{"name": {json.dumps(name)}, "label": {json.dumps(label)}, '
+                     f'"keys": [{entries}]}}'.encode())
+        self.first = False
+
+    def end(self, combos):
+        self.f.write(b'\n],\n"combos": [')
+        for i, (name, positions, binding, combo_layers, timeout) in enumerate(combos):
+            self.f.write(b",\n " if i else b"\n ")
+            self.f.write(json.dumps({"name": name, "positions": positions, "binding": binding,
+                                     "layers": combo_layers, "timeout-ms": timeout}).encode())
+        self.f.write(b"\n]}\n")
+
+
+# TOTEM keycap centers (x, y) and rotation in degrees by key position, taken
+# from the keycap outlines in docs/images/TOTEM_layout.svg. Shields with a
+# different key count are drawn on their grid instead.
+KEY_GEOMETRY = [
+    (67.2, 97.7, -10), (124.5, 53.7, -4), (182.8, 24.8, 0), (233.8, 48.8, 0), (284.8, 56.4, 0),
+    (448.2, 56.4, 0), (499.2, 48.8, 0), (550.2, 24.8, 0), (608.4, 53.7, 4), (665.8, 97.7, 10),
+    (75.5, 145.2, -10), (127.9, 101.8, -4), (182.8, 72.9, 0), (233.8, 97.0, 0), (284.8, 104.6, 0),
+    (448.2, 104.6, 0), (499.2, 97.0, 0), (550.2, 72.9, 0), (605.0, 101.8, 4), (657.5, 145.2, 10),
+    (29.8, 180.2, -10), (83.9, 192.6, -10), (131.2, 149.8, -4), (182.8, 121.1, 0),
+    (233.8, 145.2, 0), (284.8, 152.7, 0), (448.2, 152.7, 0), (499.2, 145.2, 0),
+    (550.2, 121.1, 0), (601.7, 149.8, 4), (649.1, 192.6, 10), (703.1, 180.2, 10),
+    (219.5, 203.7, 0), (276.1, 211.4, 15), (328.3, 233.2, 30),
+    (404.7, 233.2, -30), (456.9, 211.4, -15), (513.4, 203.7, 0),
+]
+DIAGRAM_HEIGHT = 300
+GRID_PITCH = 51
+
+
+def keycap_geometry(geometry):
+    """Return (x, y, rotation) of each key position for the layer diagram."""
+    if len(geometry) == len(KEY_GEOMETRY):
+        return KEY_GEOMETRY
+    return [(30 + c * GRID_PITCH, 25 + r * GRID_PITCH, 0) for r, c in geometry.cells]
+
+
+SVG_STYLE = """<style>
+  rect { fill: #161b22; stroke: #58a6ff; stroke-width: .6px; }
+  text { fill: #e6edf3; font: 11px sans-serif; text-anchor: middle; }
+  .hold { fill: #8b949e; font-size: 8px; }
+  .title { fill: #58a6ff; font-size: 16px; text-anchor: start; }
+</style>
+"""
+
+
+def key_legend(binding):
+    """Return the (tap, hold) legends shown on a key for a resolved binding."""
+    parts = binding.split()
+    if not parts or parts[0] == "&none":
+        return "", ""
+    if parts[0] == "&trans":
+        return "\u25bd", ""
+    if parts[0] in ("&mt", "&lt") and len(parts) == 3:
+        return parts[2], parts[1]
+    if parts[0] == "&kp" and len(parts) == 2:
+        return parts[1], ""
+    return binding.lstrip("&"), ""
+
+
+class SvgEmitter:
+    """Write a TOTEM-shaped diagram of every layer, stacked in one SVG.
+
+    The keycap outlines are drawn once as a shared <defs> group that every
+    layer references; legends are formatted once per distinct binding.
+    """
+
+    needs_keys = True
+
+    def __init__(self, f, count, geometry):
+        self.f = f
+        self.count = count
+        self.index = 0
+        keycaps = keycap_geometry(geometry)
+        self.width = round(max(x for x, _, _ in keycaps) + 30)
+        self.keycaps = [f'  <g transform="translate({x} {y + 30})'
+                        + (f' rotate({angle})">' if angle else '">')
+                        for x, y, angle in keycaps]
+        self.legends = {}
+
+    def legend(self, resolved):
+        tap, hold = (html.escape(s) for s in key_legend(resolved))
+        fit = ' textLength="44" lengthAdjust="spacingAndGlyphs"' if len(tap) > 7 else ""
+        hold = f'<text class="hold" y="16">{hold}</text>' if hold else ""
+        text = self.legends[resolved] = f'<text y="2"{fit}>{tap}</text>{hold}</g>\n'
+        return text
+
+    def start(self, head):
+        height = self.count * DIAGRAM_HEIGHT
+        self.f.write(f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{height}" '
+                     f'viewBox="0 0 {self.width} {height}">\n{SVG_STYLE}<defs>\n<g id="keycaps">\n'.encode())
+        self.f.write("".join(f'{keycap}<rect x="-24.8" y="-23.4" width="49.6" height="46.8" '
+                             f'rx="2.6"/></g>\n' for keycap in self.keycaps).encode())
+        self.f.write(b"</g>\n</defs>\n")
+
+    def layer(self, layer, keys):
+        parts = [f'<g id="{layer.name}" transform="translate(0 {self.index * DIAGRAM_HEIGHT})">\n'
+                 f'  <text class="title" x="8" y="20">{html.escape(layer.label)}</text>\n'
+                 f'  <use href="#keycaps"/>\n']
+        legends = self.legends
+        for keycap, (_, _, _, resolved) in zip(self.keycaps, keys):
+            parts.append(keycap)
+            parts.append(legends.get(resolved) or self.legend(resolved))
+        parts.append("</g>\n")
+        self.f.write("".join(parts).encode())
+        self.index += 1
+
+    def end(self, combos):
+        self.f.write(b"</svg>\n")
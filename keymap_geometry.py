@@ -0,0 +1,159 @@
+"""Key geometry of a ZMK shield, read from its matrix transform.
+
+The `map` of a `zmk,matrix-transform` node lists RC(row, col) for every key
+in key-position order. Where each key sits on the grid of the layer tables
+comes from the shield's layout file, `<shield>.layout.json` next to the
+.dtsi: its "grid" lists the rows of the grid with the key position of each
+cell, or null where the board has no key. A shield without a layout file is
+laid out by its matrix, each key on the grid cell (row, col) of its RC
+entry. Other shields therefore only need a layout file, never changes to
+the formatter.
+
+    geometry = load_geometry("config/boards/shields/totem/totem.dtsi")
+    geometry.cells[pos]           # grid cell (row, col) of a key position
+    geometry.rcs[pos]             # matrix (row, col) of a key position
+    geometry.positions[(r, c)]    # key position of a grid cell
+    geometry.rc_positions[(r, c)] # key position of a matrix entry
+"""
+
+import functools
+import json
+import os
+import re
+
+RC_ENTRY = re.compile(r"RC\(\s*(\d+)\s*,\s*(\d+)\s*\)")
+
+
+class Geometry:
+    """Lookups between grid cells, matrix entries and ZMK key positions.
+
+    The grid is rows x cols cells; split is the last grid column of the left
+    half, after which format_layer leaves the gap between the halves. Without
+    a split it is the column left of the middle.
+    """
+
+    def __init__(self, cells, rcs, matrix, split=None):
+        self.cells = cells
+        self.rcs = rcs
+        self.matrix = matrix
+        self.rows = max(r for r, _ in cells) + 1
+        self.cols = max(c for _, c in cells) + 1
+        self.split = self.cols // 2 - 1 if split is None else split
+        self.positions = {cell: pos for pos, cell in enumerate(cells)}
+        self.rc_positions = {rc: pos for pos, rc in enumerate(rcs)}
+
+    def __len__(self):
+        return len(self.cells)
+
+    def empty_grid(self):
+        """Return a grid with every cell empty."""
+        return [[""] * self.cols for _ in range(self.rows)]
+
+    def check_grid(self, grid):
+        """Return why grid does not match the key positions, or None."""
+        if len(grid) != self.rows or any(len(row) != self.cols for row in grid):
+            return f"expected {self.rows} rows of {self.cols} cells"
+        return self.check_cells(self.cols, [key for row in grid for key in row])
+
+    def check_cells(self, width, cells):
+        """Return why a grid width cells wide, given in row-major order, does not match, or None.
+
+        A falsy cell (an empty binding or binding ID 0) is an empty cell.
+        """
+        if width != self.cols or len(cells) != self.rows * self.cols:
+            return f"expected {self.rows} rows of {self.cols} cells"
+        for i, key in enumerate(cells):
+            cell = divmod(i, width)
+            pos = self.positions.get(cell)
+            if key and pos is None:
+                return f"cell {cell} is not a key position"
+            if not key and pos is not None:
+                return f"cell {cell} is key position {pos} but empty"
+        return None
+
+
+def find_split(cells, cols):
+    """Return the grid column in the middle of the widest gap within a row, or None.
+
+    Gaps equally wide are told apart by how close they are to the grid's middle.
+    """
+    gaps = []
+    for r in {r for r, _ in cells}:
+        row = sorted(c for line, c in cells if line == r)
+        gaps += [(b - a, -abs(a + b - cols + 1), a + (b - a) // 2)
+                 for a, b in zip(row, row[1:]) if b - a > 1]
+    return max(gaps)[2] if gaps else None
+
+
+def transform_nodes(text):
+    """Return {label: body} of the labelled `zmk,matrix-transform` nodes in text."""
+    nodes = re.findall(r"(\w+):\s*[\w@,-]+\s*\{(.*?)^\s*\};", text, re.S | re.M)
+    return {label: body for label, body in nodes if '"zmk,matrix-transform"' in body}
+
+
+def layout_cells(grid, count):
+    """Return the grid cell of each of count key positions in a layout grid.
+
+    Raises ValueError unless every key position is on exactly one cell.
+    """
+    cells = {}
+    for r, row in enumerate(grid):
+        for c, pos in enumerate(row):
+            if pos is None:
+                continue
+            if pos in cells:
+                raise ValueError(f"layout: key position {pos} is on two cells")
+            cells[pos] = (r, c)
+    if sorted(cells) != list(range(count)):
+        raise ValueError(f"layout: expected key positions 0 to {count - 1}")
+    return [cells[pos] for pos in range(count)]
+
+
+def parse_transform(text, layout=None):
+    """Return the Geometry of the matrix transform chosen in a devicetree source.
+
+    Uses the node `zmk,matrix_transform` in /chosen points to, else the first
+    transform node. layout is the "grid" of the shield's layout file; without
+    one each key sits on the cell of its RC entry. Raises ValueError when
+    there is no transform node, or its map does not fit its rows and columns
+    or the layout.
+    """
+    transforms = transform_nodes(text)
+    if not transforms:
+        raise ValueError("no zmk,matrix-transform node")
+    chosen = re.search(r"zmk,matrix_transform\s*=\s*&(\w+)", text)
+    label = chosen.group(1) if chosen and chosen.group(1) in transforms else next(iter(transforms))
+    body = transforms[label]
+    matrix = tuple(int(re.search(rf"\b{prop}\s*=\s*<(\d+)>", body).group(1))
+                   for prop in ("rows", "columns"))
+    body = re.sub(r"//[^\n]*|/\*.*?\*/", "", body, flags=re.S)
+    entries = RC_ENTRY.findall(re.search(r"\bmap\s*=\s*<(.*?)>;", body, re.S).group(1))
+    rcs = [(int(r), int(c)) for r, c in entries]
+    if not rcs:
+        raise ValueError(f"{label}: empty map")
+    bad = [rc for rc in rcs if not (rc[0] < matrix[0] and rc[1] < matrix[1])]
+    if bad:
+        raise ValueError(f"{label}: {bad} outside the {matrix[0]}x{matrix[1]} matrix")
+    if len(set(rcs)) != len(rcs):
+        raise ValueError(f"{label}: matrix entries used twice")
+    cells = list(rcs) if layout is None else layout_cells(layout, len(rcs))
+    return Geometry(cells, rcs, matrix, find_split(cells, max(c for _, c in cells) + 1))
+
+
+def layout_path(path):
+    """Return the path of the layout file of the shield .dtsi/.overlay at path."""
+    return os.path.splitext(path)[0] + ".layout.json"
+
+
+@functools.lru_cache(maxsize=None)
+def load_geometry(path):
+    """Return the Geometry of the .dtsi/.overlay at path, parsed once per path."""
+    with open(path) as f:
+        text = f.read()
+    layout = None
+    if os.path.exists(layout_path(path)):
+        with open(layout_path(path)) as f:
+            layout = json.load(f).get("grid")
+        if not isinstance(layout, list):
+            raise ValueError(f"{layout_path(path)}: no \"grid\" list")
+    return parse_transform(text, layout)
@@ -0,0 +1,98 @@
+"""Wait for saves to a set of files, for the generator's --watch mode.
+
+Uses inotify through ctypes where the C library has it, so a save is seen
+as soon as the editor closes the file, and polls the files' mtimes
+elsewhere. Saves arriving in a quick burst are reported once.
+"""
+
+import ctypes
+import os
+import select
+import struct
+import time
+
+INOTIFY_EVENT = struct.Struct("iIII")
+IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x008, 0x080, 0x100
+DEBOUNCE_S = 0.015
+POLL_S = 0.01
+
+
+def inotify_watch(directories):
+    """Return (fd, {wd: directory}) watching directories for written files, or None."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    watches = {}
+    for directory in directories:
+        wd = libc.inotify_add_watch(fd, os.fsencode(directory), mask)
+        if wd < 0:
+            os.close(fd)
+            return None
+        watches[wd] = directory
+    return fd, watches
+
+
+def inotify_paths(fd, watches, timeout):
+    """Return the set of file paths of events read within timeout seconds."""
+    paths = set()
+    if select.select([fd], [], [], timeout)[0]:
+        data = os.read(fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            wd, _, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            paths.add(os.path.join(watches[wd], name))
+            offset += length
+    return paths
+
+
+def watch_changes(paths):
+    """Yield once per burst of saves to any of paths.
+
+    Uses inotify on the files' directories (editors often replace a file
+    instead of writing it in place) and falls back to polling the mtimes.
+    A burst ends once no further save arrives for DEBOUNCE_S. Closing the
+    generator closes the inotify descriptor.
+    """
+    paths = {os.path.abspath(path) for path in paths}
+    watched = inotify_watch({os.path.dirname(path) for path in paths})
+    if watched is not None:
+        fd, watches = watched
+        try:
+            while True:
+                if paths & inotify_paths(fd, watches, None):
+                    while paths & inotify_paths(fd, watches, DEBOUNCE_S):
+                        pass
+                    yield
+        finally:
+            os.close(fd)
+
+    def mtime():
+        stamps = []
+        for path in sorted(paths):
+            try:
+                stamps.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                stamps.append(None)
+        return stamps
+
+    last = mtime()
+    while True:
+        time.sleep(POLL_S)
+        current = mtime()
+        if current == last:
+            continue
+        while True:
+            time.sleep(DEBOUNCE_S)
+            settled = mtime()
+            if settled == current:
+                break
+            current = settled
+        last = current
+        yield
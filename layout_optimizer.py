@@ -0,0 +1,311 @@
+"""Corpus-driven placement search for the symbol/bracket/number layers.
+
+Used by `format_keymap.py optimize`. Every movable cell of the selected layers
+is a slot; a right-hand cell holding the same binding as a left-hand cell of
+the same layer (the mirrored symbol layers) is linked into one slot so the
+pair moves together. Bindings are only swapped between slots of the same
+size, so mirrored symbols stay mirrored. Bindings the corpus never produces
+stay where they are, except `&none`, which marks a free slot.
+
+A layout costs
+
+    sum(count[s] * effort[slot[s]]) + sum(bigrams[s, t] * pair[slot[s], slot[t]])
+
+where effort includes holding the layer key on the same hand and pair covers
+same-finger bigrams and layer switches. Simulated annealing runs many chains
+per worker as arrays and scores swaps incrementally, so each step evaluates a
+whole batch of candidate layouts at once.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from format_keymap import format_layer_source
+
+# Effort per cell of the TOTEM grid, which the shield's geometry must match.
+# Cells with no effort (thumbs, outer pinky keys, absent cells) are not movable.
+EFFORT = [
+    [0.0, 3.0, 2.0, 1.6, 2.0, 3.0, 0.0, 0.0, 3.0, 2.0, 1.6, 2.0, 3.0, 0.0],
+    [0.0, 1.6, 1.2, 1.0, 1.0, 2.0, 0.0, 0.0, 2.0, 1.0, 1.0, 1.2, 1.6, 0.0],
+    [0.0, 3.2, 2.6, 2.2, 1.8, 3.2, 0.0, 0.0, 3.2, 1.8, 2.2, 2.6, 3.2, 0.0],
+    [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0],
+]
+# Finger per grid column: 0-3 left pinky..index, 4-7 right index..pinky
+FINGER = [0, 0, 1, 2, 3, 3, -1, -1, 4, 4, 5, 6, 7, 7]
+FIXED_BINDINGS = ("&trans",)
+FREE_BINDING = "&none"
+
+SAME_FINGER = 2.5    # cost of a same-finger bigram on different keys
+LAYER_SWITCH = 1.5   # cost of a bigram whose keys sit on different layers
+SAME_HAND_HOLD = 0.8  # effort added when the layer key is held by the same hand
+
+# Characters produced by `&kp KEY` and `&kp LS(KEY)`
+KEY_CHARS = {
+    **{chr(c): (chr(c).lower(), chr(c)) for c in range(ord("A"), ord("Z") + 1)},
+    **{f"N{d}": (str(d), ")!@#$%^&*("[d]) for d in range(10)},
+    "MINUS": ("-", "_"), "EQUAL": ("=", "+"), "LBKT": ("[", "{"), "RBKT": ("]", "}"),
+    "BSLH": ("\\", "|"), "SEMI": (";", ":"), "SQT": ("'", '"'), "GRAVE": ("`", "~"),
+    "COMMA": (",", "<"), "DOT": (".", ">"), "FSLH": ("/", "?"),
+    "SPACE": (" ", " "), "RET": ("\n", "\n"), "TAB": ("\t", "\t"),
+}
+
+
+def binding_char(binding, single_macros):
+    """Return the character a binding types, or None."""
+    binding = single_macros.get(binding[1:], binding)
+    parts = binding.split()
+    if len(parts) != 2 or parts[0] != "&kp":
+        return None
+    key = parts[1]
+    if key.startswith("LS(") and key.endswith(")"):
+        chars = KEY_CHARS.get(key[3:-1])
+        return chars[1] if chars else None
+    chars = KEY_CHARS.get(key)
+    return chars[0] if chars else None
+
+
+def check_tables(geometry):
+    """Return why EFFORT/FINGER do not fit the shield geometry, or None."""
+    if len(EFFORT) != geometry.rows or any(len(row) != geometry.cols for row in EFFORT) \
+            or len(FINGER) != geometry.cols:
+        return (f"effort tables cover a {len(EFFORT)}x{len(FINGER)} grid, "
+                f"the shield has {geometry.rows}x{geometry.cols}")
+    return None
+
+
+def layer_thumbs(layers, defines, base, geometry):
+    """Return {layer name: grid column of the base-layer thumb that holds it}.
+
+    The thumbs are the last row of the grid.
+    """
+    grid = next(g for name, _, g in layers if name == base)
+    thumbs = {}
+    for c, key in enumerate(grid[geometry.rows - 1]):
+        parts = defines.get(key, key).split()
+        if parts and parts[0] in ("&lt", "&mo"):
+            const = parts[1]
+            index = int(defines.get(const, const))
+            if index < len(layers):
+                thumbs[layers[index][0]] = c
+    return thumbs
+
+
+def build_slots(layers, names, geometry):
+    """Group movable cells of the named layers into slots.
+
+    Returns a list of (layer name, [cells], binding) with cells as (row, col).
+    """
+    movable = sorted(cell for cell in geometry.cells if EFFORT[cell[0]][cell[1]])
+    slots = []
+    for name, _, grid in layers:
+        if name not in names:
+            continue
+        cells = [(r, c) for r, c in movable if grid[r][c] and grid[r][c] not in FIXED_BINDINGS]
+        left = [cell for cell in cells if cell[1] <= geometry.split]
+        right = [cell for cell in cells if cell[1] > geometry.split]
+        groups = {cell: [cell] for cell in left}
+        for r, c in right:
+            key = grid[r][c]
+            mirror = (r, geometry.cols - 1 - c)
+            if key != FREE_BINDING and mirror in groups and len(groups[mirror]) == 1 \
+                    and grid[mirror[0]][mirror[1]] == key:
+                groups[mirror].append((r, c))
+                continue
+            match = next((cell for cell in left if len(groups[cell]) == 1
+                          and grid[cell[0]][cell[1]] == key != FREE_BINDING), None)
+            if match:
+                groups[match].append((r, c))
+            else:
+                groups[(r, c)] = [(r, c)]
+        for cells in groups.values():
+            slots.append((name, cells, grid[cells[0][0]][cells[0][1]]))
+    return slots
+
+
+def cost_tables(slots, thumbs, split):
+    """Return (effort per slot, pair cost per slot pair) as arrays."""
+    n = len(slots)
+    effort = np.zeros(n)
+    for s, (name, cells, _) in enumerate(slots):
+        thumb = thumbs.get(name)
+        costs = []
+        for r, c in cells:
+            same_hand = thumb is not None and (thumb <= split) == (c <= split)
+            costs.append(EFFORT[r][c] + (SAME_HAND_HOLD if same_hand else 0.0))
+        effort[s] = min(costs)
+    pair = np.zeros((n, n))
+    for s, (name_s, cells_s, _) in enumerate(slots):
+        for t, (name_t, cells_t, _) in enumerate(slots):
+            if s == t:
+                continue
+            # With mirrored copies the typist picks whichever pair of copies is cheapest.
+            sfb = min(SAME_FINGER if FINGER[a[1]] == FINGER[b[1]] and a != b else 0.0
+                      for a in cells_s for b in cells_t)
+            pair[s, t] = sfb + (LAYER_SWITCH if name_s != name_t else 0.0)
+    return effort, pair
+
+
+def corpus_counts(paths, slots, single_macros, keylog=False):
+    """Count unigrams and bigrams of the slot bindings over the corpus files.
+
+    Text files are read as characters; with keylog=True each line is one
+    binding (e.g. `&pc_copy`). Counts of a binding found in several slots are
+    split evenly between them.
+    """
+    ids = {}
+    for s, (_, _, binding) in enumerate(slots):
+        token = binding if keylog else binding_char(binding, single_macros)
+        if token is not None:
+            ids.setdefault(token, []).append(s)
+    n = len(slots)
+    uni = np.zeros(n)
+    bi = np.zeros((n, n))
+    tokens = sorted(ids)
+    index = {tok: i for i, tok in enumerate(tokens)}
+    for path in paths:
+        with open(path, encoding="utf-8", errors="replace") as f:
+            seq = [line.strip() for line in f] if keylog else f.read()
+        codes = np.fromiter((index.get(tok, -1) for tok in seq), dtype=np.int64)
+        valid = codes >= 0
+        tok_uni = np.bincount(codes[valid], minlength=len(tokens))
+        pairs = valid[:-1] & valid[1:]
+        flat = codes[:-1][pairs] * len(tokens) + codes[1:][pairs]
+        tok_bi = np.bincount(flat, minlength=len(tokens) ** 2).reshape(len(tokens), len(tokens))
+        for a, tok_a in enumerate(tokens):
+            slots_a = ids[tok_a]
+            uni[slots_a] += tok_uni[a] / len(slots_a)
+            for b, tok_b in enumerate(tokens):
+                if tok_bi[a, b]:
+                    slots_b = ids[tok_b]
+                    bi[np.ix_(slots_a, slots_b)] += tok_bi[a, b] / (len(slots_a) * len(slots_b))
+    return uni, bi
+
+
+def pools(slots, uni):
+    """Return the pool id of each item; items only swap within their pool.
+
+    Pools split items by slot size. A binding present in several of the
+    selected layers only moves within its own layer, so no layer ends up
+    with two copies of it.
+    """
+    layers_of = {}
+    for name, _, binding in slots:
+        layers_of.setdefault(binding, set()).add(name)
+    keys = {}
+    pool = np.empty(len(slots), dtype=np.int64)
+    for s, (name, cells, binding) in enumerate(slots):
+        if uni[s] == 0 and binding != FREE_BINDING:
+            key = ("fixed", s)
+        elif binding != FREE_BINDING and len(layers_of[binding]) > 1:
+            key = (len(cells), name)
+        else:
+            key = (len(cells), None)
+        pool[s] = keys.setdefault(key, len(keys))
+    return pool
+
+
+def score(perm, uni, w, effort, pair):
+    """Score a batch of layouts; perm[b, item] is the slot holding item."""
+    unary = (effort[perm] * uni).sum(axis=1)
+    binary = (w[None] * pair[perm[:, :, None], perm[:, None, :]]).sum(axis=(1, 2)) / 2
+    return unary + binary
+
+
+def anneal(uni, w, effort, pair, pool, chains, steps, seed, t0=None):
+    """Run a batch of annealing chains with swap moves.
+
+    Returns (best score, best permutation) over all chains.
+    """
+    rng = np.random.default_rng(seed)
+    n = len(uni)
+    order = np.argsort(pool, kind="stable")
+    sorted_pool = pool[order]
+    starts = np.searchsorted(sorted_pool, pool)
+    sizes = np.searchsorted(sorted_pool, pool, side="right") - starts
+
+    perm = np.tile(np.arange(n), (chains, 1))
+    for b in range(1, chains):
+        # Start every chain but the first from a random pool-respecting shuffle.
+        for p in np.unique(pool):
+            items = np.flatnonzero(pool == p)
+            perm[b, items] = rng.permutation(perm[b, items])
+    current = score(perm, uni, w, effort, pair)
+    best, best_perm = current.copy(), perm.copy()
+    rows = np.arange(chains)
+
+    def propose():
+        i = rng.integers(n, size=chains)
+        j = order[starts[i] + (rng.random(chains) * sizes[i]).astype(np.int64)]
+        ci, cj = perm[rows, i], perm[rows, j]
+        du = (uni[i] - uni[j]) * (effort[cj] - effort[ci])
+        d = (w[i] - w[j]) * (pair[cj[:, None], perm] - pair[ci[:, None], perm])
+        d[rows, i] = 0.0
+        d[rows, j] = 0.0
+        return i, j, ci, cj, du + d.sum(axis=1)
+
+    if t0 is None:
+        deltas = np.abs(propose()[-1])
+        t0 = float(deltas[deltas > 0].mean()) if (deltas > 0).any() else 1.0
+    temps = t0 * np.geomspace(1.0, 1e-3, steps)
+    for temp in temps:
+        i, j, ci, cj, delta = propose()
+        accept = (delta < 0) | (rng.random(chains) < np.exp(-np.maximum(delta, 0) / temp))
+        acc = rows[accept]
+        perm[acc, i[accept]] = cj[accept]
+        perm[acc, j[accept]] = ci[accept]
+        current[accept] += delta[accept]
+        improved = current < best
+        best[improved] = current[improved]
+        best_perm[improved] = perm[improved]
+    k = int(np.argmin(best))
+    # Recompute exactly to shed accumulated rounding.
+    return float(score(best_perm[k:k + 1], uni, w, effort, pair)[0]), best_perm[k]
+
+
+def _anneal_job(job):
+    return anneal(*job)
+
+
+def apply_layout(layers, slots, perm):
+    """Return copies of the layers with each item's binding moved to its new slot."""
+    grids = {name: [list(row) for row in grid] for name, _, grid in layers}
+    for item, slot in enumerate(perm):
+        name, cells, _ = slots[slot]
+        for r, c in cells:
+            grids[name][r][c] = slots[item][2]
+    return [(name, label, grids[name]) for name, label, _ in layers]
+
+
+def optimize(layers, defines, single_macros, args, geometry):
+    """Run the search described by the `optimize` command-line arguments."""
+    names = args.layers.split(",")
+    unknown = set(names) - {name for name, _, _ in layers}
+    if unknown:
+        raise SystemExit(f"Unknown layers: {', '.join(sorted(unknown))}")
+    mismatch = check_tables(geometry)
+    if mismatch:
+        raise SystemExit(f"Cannot optimize for this shield: {mismatch}")
+    slots = build_slots(layers, names, geometry)
+    thumbs = layer_thumbs(layers, defines, args.base, geometry)
+    effort, pair = cost_tables(slots, thumbs, geometry.split)
+    uni, bi = corpus_counts(args.corpus, slots, single_macros, args.keylog)
+    w = bi + bi.T
+    np.fill_diagonal(w, 0.0)
+    pool = pools(slots, uni)
+
+    initial = float(score(np.arange(len(slots))[None], uni, w, effort, pair)[0])
+    jobs = args.jobs or os.cpu_count() or 1
+    work = [(uni, w, effort, pair, pool, args.chains, args.steps, args.seed + k)
+            for k in range(jobs)]
+    with ProcessPoolExecutor(max_workers=jobs) as pool_exec:
+        results = list(pool_exec.map(_anneal_job, work))
+    best, perm = min(results, key=lambda r: r[0])
+
+    evaluations = jobs * args.chains * args.steps
+    print(f"# {len(slots)} slots, {evaluations} layout evaluations over {jobs} workers")
+    print(f"# cost {initial:.0f} -> {best:.0f}")
+    for name, label, grid in apply_layout(layers, slots, perm):
+        if name in names:
+            print(format_layer_source(name, label, grid))
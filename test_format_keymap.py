@@ -0,0 +1,188 @@
+"""Regression tests for the keymap generator; run with `python -m pytest`."""
+
+import pytest
+
+import format_keymap as fk
+
+
+MINI_SHIELD = """
+    t: transform {
+        compatible = "zmk,matrix-transform";
+        rows = <2>;
+        columns = <3>;
+        map = <RC(0,0) RC(0,2) RC(0,1) RC(1,0) RC(1,2) RC(1,1)>;
+    };"""
+
+
+def without_thumbs(grid, names):
+    """Return grid with every binding in names replaced by &none."""
+    return [["&none" if key in names else key for key in row] for row in grid]
+
+
+def test_prune_unused_drops_unreachable_layer():
+    # Without the numbers thumbs nothing reaches numbers_layer any more.
+    layers = [fk.Layer(name, label, without_thumbs(grid, {"pcl_nu", "mcl_nu"}))
+              for name, label, grid in fk.layers]
+    out_layers, _, head, report = fk.prune_unused(layers, fk.macros, fk.header, fk.combos,
+                                                  fk.shield_geometry())
+    assert "numbers_layer" in report["layers"]
+    assert "numbers_layer" not in [name for name, _, _ in out_layers]
+    assert "NUMBERS" not in fk.parse_defines(head)
+
+
+def test_inline_macros_rewrites_combo_bindings():
+    combo_table = [("combo_x", [(0, 2), (0, 3)], "&k_excl", None, 30)]
+    _, groups, combo_table, removed = fk.inline_macros(fk.layers, fk.macros, combo_table)
+    assert combo_table[0][2] == "&kp LS(N1)"
+    assert removed["combos"] == 1
+    assert "k_excl" not in [name for _, entries in groups for name, _ in entries]
+
+
+def test_iter_keymap_ignores_comments():
+    with open("config/boards/shields/totem/totem.keymap") as f:
+        sections = fk.iter_keymap(f, fk.shield_geometry())
+        parsed = [value for kind, _, value in sections if kind == "layer"]
+    name, label, grid = parsed[0]
+    assert (name, label) == ("base_layer", "BASE")
+    assert grid[0][1] == "&kp Q" and grid[3][7] == "&lt SYM RET"
+
+
+def test_optimizer_rejects_other_shield_grid():
+    import layout_optimizer
+    from keymap_geometry import parse_transform
+    mini = parse_transform(MINI_SHIELD)
+    assert layout_optimizer.check_tables(fk.shield_geometry()) is None
+    assert "2x3" in layout_optimizer.check_tables(mini)
+
+
+def test_geometry_follows_map_order_and_layout():
+    from keymap_geometry import parse_transform
+    # Without a layout every key sits on the cell of its RC entry.
+    geometry = parse_transform(MINI_SHIELD)
+    assert geometry.cells == [(0, 0), (0, 2), (0, 1), (1, 0), (1, 2), (1, 1)]
+    geometry = parse_transform(MINI_SHIELD, [[0, 1, None, None, 2], [3, 4, None, None, 5]])
+    assert geometry.positions[(1, 4)] == 5 and geometry.rcs[5] == (1, 1)
+    assert geometry.split == 2
+    with pytest.raises(ValueError, match="key position"):
+        parse_transform(MINI_SHIELD, [[0, 1, 2], [3, 4, 4]])
+
+
+def test_format_macros_round_trips_multi_step_macros():
+    text = fk.format_macros(fk.macros)
+    assert "                bt0_pc: bt0_pc {\n" in text
+    sections = fk.iter_keymap(text.splitlines(True), fk.shield_geometry())
+    parsed = [value for kind, _, value in sections if kind == "macros"]
+    groups, multi_line = parsed[0]
+    assert groups == [(comment, [(name, list(b)) for name, b in entries])
+                      for comment, entries in fk.macros]
+    assert multi_line == {"bt0_pc", "bt1_mac", "pc_dlls", "pc_dlle"}
+
+
+def test_check_keymap_keeps_one_line_multi_step_macros(tmp_path):
+    # The hand-kept keymap the generator started from wrote pc_dlls on one line.
+    text = fk.header + fk.format_macros(fk.macros, {"bt0_pc", "bt1_mac"})
+    text += "".join(f"\n{fk.format_layer(*layer, fk.shield_geometry())}\n" for layer in fk.layers)
+    path = tmp_path / "one_line.keymap"
+    path.write_text(text + fk.footer)
+    assert "pc_dlls: pc_dlls { compatible" in text
+    assert fk.check_keymap(str(path), fk.shield_geometry()) is None
+
+
+def test_render_variant_inlines_macros_set_by_spec(tmp_path):
+    spec = tmp_path / "m.json"
+    spec.write_text('{"cells": {"symbols_layer": [[0, 1, "&k_excl"]]}}')
+    path, _, _ = fk.render_variant((str(spec), str(tmp_path), True, True, (None, None),
+                                    fk.COMBOS_PER_KEY, (), fk.SHIELD_PATH))
+    text = open(path).read()
+    assert "&k_excl" not in text
+    assert "&kp LS(N1)" in text.split("symbols_layer {", 1)[1].split("};", 1)[0]
+
+
+def test_render_variant_counts_only_written_bytes(tmp_path):
+    spec = tmp_path / "v.json"
+    spec.write_text("{}")
+    job = (str(spec), str(tmp_path), True, True, (None, None), fk.COMBOS_PER_KEY, ("json",),
+           fk.SHIELD_PATH)
+    path, rendered, written = fk.render_variant(job)
+    assert rendered == written > (tmp_path / "v.keymap").stat().st_size
+    assert fk.render_variant(job) == (path, rendered, 0)
+
+
+def test_apply_spec_drop_layers_renumbers():
+    out_layers, _, head = fk.apply_spec(fk.layers, fk.macros, fk.header,
+                                        {"drop_layers": ["qwerty_gaming_layer"]},
+                                        fk.shield_geometry())
+    defines = fk.parse_defines(head)
+    assert "qwerty_gaming_layer" not in [name for name, _, _ in out_layers]
+    assert "QWERTY_GAMING" not in defines and "to_game" not in defines
+    assert (defines["COLEMAK_MAC"], defines["SYMBOLS"], defines["BLUETOOTH"]) == ("1", "2", "11")
+    bluetooth = dict((name, grid) for name, _, grid in out_layers)["bluetooth_layer"]
+    assert "to_game" not in [key for row in bluetooth for key in row]
+
+
+def test_inline_macros_rewrites_steps_of_kept_macros():
+    groups = [("g", [("a", ["&kp A"]), ("m", ["&a", "&kp B"])])]
+    _, groups, _, _ = fk.inline_macros([], groups)
+    assert groups == [("g", [("m", ["&kp A", "&kp B"])])]
+
+
+def test_resolve_combos_rejects_unknown_layer():
+    geometry = fk.shield_geometry()
+    combo_table = [("combo_x", [(0, 2), (0, 3)], "&kp ESC", ["colemak_pc"], 30)]
+    with pytest.raises(ValueError, match="colemak_pc"):
+        fk.resolve_combos(combo_table, fk.layers, geometry, fk.layers)
+    pruned = [layer for layer in fk.layers if layer[0] != "colemak_pc_layer"]
+    combo_table = [("combo_x", [(0, 2), (0, 3)], "&kp ESC", ["colemak_pc_layer"], 30)]
+    assert fk.resolve_combos(combo_table, pruned, geometry, fk.layers) == []
+
+
+def test_layer_shares_its_grid_and_hashes_bindings_not_ids():
+    layer = fk.Layer("x", "X", [["&kp A", ""], ["", "&kp B"]])
+    assert layer[0] == "x" and layer[1] == "X" and layer._grid is None
+    assert layer.grid is layer.grid
+    other, changed = layer.map_bindings(lambda key: key.replace("A", "C"))
+    assert changed == 1 and other.grid == [("&kp C", ""), ("", "&kp B")]
+    assert other.content_key() != layer.content_key()
+    assert fk.Layer("x", "X", [["&kp A", ""], ["", "&kp B"]]).content_key() == layer.content_key()
+
+
+def render_cached(path, layers, cache, monkeypatch):
+    """Write layers to path with cache; return (written, changed, re-rendered layer names)."""
+    rendered = []
+    render = fk.KeymapEmitter.render
+    monkeypatch.setattr(fk.KeymapEmitter, "render",
+                        lambda self, layer: rendered.append(layer.name) or render(self, layer))
+    written, changed, _ = fk.write_outputs({"keymap": str(path)}, fk.header, layers, fk.macros,
+                                           fk.shield_geometry(), (), cache)
+    return written, changed, rendered
+
+
+def test_cache_unchanged_run_reports_and_rewrites_nothing(tmp_path, monkeypatch):
+    path, cache = tmp_path / "x.keymap", {}
+    layers = [fk.Layer(*layer) for layer in fk.layers]
+    written, changed, _ = render_cached(path, layers, cache, monkeypatch)
+    assert written == [str(path)] and changed[:2] == ["header", layers[0].name]
+    before = path.stat()
+    assert render_cached(path, layers, cache, monkeypatch) == ([], [], [])
+    assert (path.stat().st_ino, path.stat().st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+
+
+def test_cache_rerenders_only_the_edited_layer(tmp_path, monkeypatch):
+    path, cache = tmp_path / "x.keymap", {}
+    layers = [fk.Layer(*layer) for layer in fk.layers]
+    render_cached(path, layers, cache, monkeypatch)
+    edited, _ = layers[2].map_bindings(lambda key: key, {(0, 1): "&kp Z"})
+    layers[2] = edited
+    written, changed, rendered = render_cached(path, layers, cache, monkeypatch)
+    assert written == [str(path)]
+    assert changed == rendered == [edited.name]
+
+
+def test_cache_reports_removed_layer(tmp_path, monkeypatch):
+    path, cache = tmp_path / "x.keymap", {}
+    layers = [fk.Layer(*layer) for layer in fk.layers]
+    render_cached(path, layers, cache, monkeypatch)
+    written, changed, rendered = render_cached(path, layers[:-1], cache, monkeypatch)
+    assert written == [str(path)]
+    assert changed == [layers[-1].name] and rendered == []
+    assert layers[-1].name not in cache["layers"]
@@ -0,0 +1,86 @@
+"""Tests for the hold-tap resolution of holdtap_sim; run with `python -m pytest`."""
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import holdtap_sim as hs
+
+
+def keystrokes(*strokes):
+    """Return Keystrokes of (position, down, up[, intent]) strokes; position 0 is a hold-tap."""
+    events = []
+    for pos, down, up, *intent in strokes:
+        intent = intent[0] if intent else -1
+        events += [(down, pos, 1, intent), (up, pos, 0, intent)]
+    events = np.array(sorted(events), dtype=np.int64)
+    return hs.Keystrokes(events, [0])
+
+
+# Hold-tap pressed at 0 and released at 120. NESTED taps another key inside
+# the hold, ROLL presses the other key before the release and lets go after.
+NESTED = [(0, 0, 120), (1, 50, 80)]
+ROLL = [(0, 0, 70), (1, 50, 100)]
+
+
+@pytest.mark.parametrize("flavor, strokes, hold, resolved_at", [
+    ("tap-preferred", NESTED, [False, False], [120, 50]),
+    ("hold-preferred", NESTED, [True, False], [50, 50]),
+    ("balanced", NESTED, [True, False], [80, 50]),
+    ("tap-preferred", ROLL, [False, False], [70, 50]),
+    ("hold-preferred", ROLL, [True, False], [50, 50]),
+    ("balanced", ROLL, [False, False], [70, 50]),
+    ("tap-preferred", [(0, 0, 300)], [True], [200]),
+])
+def test_resolve_flavors(flavor, strokes, hold, resolved_at):
+    got_hold, got_at = hs.resolve(keystrokes(*strokes), 200, 0, flavor, False)
+    assert got_hold.tolist() == hold
+    assert got_at.tolist() == resolved_at
+
+
+def test_resolve_rejects_unknown_flavor():
+    with pytest.raises(ValueError, match="Unknown flavor"):
+        hs.resolve(keystrokes(*NESTED), 200, 0, "tap-unless-interrupted", False)
+
+
+@pytest.mark.parametrize("quick_tap, global_quick_tap, hold", [
+    (0, False, True),     # quick-tap off: the second press times out into a hold
+    (150, False, False),  # tapped 100 ms before, so it taps at once
+    (50, False, True),    # tapped too long ago
+    (150, True, False),
+])
+def test_resolve_quick_tap_after_tap(quick_tap, global_quick_tap, hold):
+    ks = keystrokes((0, 0, 50), (0, 100, 400))
+    got_hold, got_at = hs.resolve(ks, 200, quick_tap, "hold-preferred", global_quick_tap)
+    assert got_hold.tolist() == [False, hold]
+    assert got_at[1] == (300 if hold else 100)
+
+
+@pytest.mark.parametrize("global_quick_tap, hold", [(False, True), (True, False)])
+def test_resolve_global_quick_tap_counts_other_keys(global_quick_tap, hold):
+    ks = keystrokes((1, 0, 30), (0, 100, 400))
+    got_hold, _ = hs.resolve(ks, 200, 150, "hold-preferred", global_quick_tap)
+    assert got_hold.tolist() == [False, hold]
+
+
+def test_resolve_quick_tap_ignores_prior_hold():
+    ks = keystrokes((0, 0, 300), (0, 350, 700))
+    got_hold, got_at = hs.resolve(ks, 200, 400, "hold-preferred", False)
+    assert got_hold.tolist() == [True, True]
+    assert got_at.tolist() == [200, 550]
+
+
+@pytest.mark.parametrize("flavor, delay", [
+    ("tap-preferred", [120, 70]),
+    ("hold-preferred", [50, 0]),
+    ("balanced", [80, 30]),
+])
+def test_evaluate_delays_keys_pressed_while_undecided(flavor, delay):
+    got_delay, _, _ = hs.evaluate(keystrokes(*NESTED), 200, 0, flavor, False)
+    assert got_delay.tolist() == delay
+
+
+def test_evaluate_counts_misfires_against_intent():
+    ks = keystrokes((0, 0, 120, 0), (1, 50, 80), (0, 200, 260, 1))
+    _, tap_as_hold, hold_as_tap = hs.evaluate(ks, 200, 0, "hold-preferred", False)
+    assert (tap_as_hold, hold_as_tap) == (1, 1)
@@ -0,0 +1,23 @@
+"""Tests for the --watch file watcher; run with `python -m pytest`."""
+
+import os
+import threading
+
+import keymap_watch
+
+
+def open_fds():
+    return set(os.listdir("/proc/self/fd")) if os.path.isdir("/proc/self/fd") else set()
+
+
+def test_watch_changes_yields_on_save_and_closes_inotify(tmp_path):
+    path = tmp_path / "spec.py"
+    path.write_text("a = 1\n")
+    before = open_fds()
+    changes = keymap_watch.watch_changes([str(path)])
+    saver = threading.Timer(0.05, path.write_text, ["a = 2\n"])
+    saver.start()
+    next(changes)
+    saver.join()
+    changes.close()
+    assert open_fds() <= before